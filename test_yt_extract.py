@@ -0,0 +1,87 @@
+# Tests for yt_extract.py, the fields worked out from a channel's raw data.
+# Run with:  python -m pytest -q
+
+import time
+
+import pytest
+
+from yt_extract import parse_keywords, find_emails, channel_country
+
+
+#####################################
+# parse_keywords
+#####################################
+
+def test_parse_keywords_keeps_quoted_phrases():
+    assert set(parse_keywords('surfing "how to surf" hawaii').split(',')) == {"surfing", "how to surf", "hawaii"}
+
+
+def test_parse_keywords_lowercases_and_drops_duplicates():
+    assert set(parse_keywords('Surfing surfing "Big Waves" "big waves"').split(',')) == {"surfing", "big waves"}
+
+
+def test_parse_keywords_adds_search_keyword():
+    assert set(parse_keywords('surfing', search_keyword="surf lessons").split(',')) == {"surfing", "surf lessons"}
+
+
+def test_parse_keywords_empty():
+    assert parse_keywords('') == ''
+    assert parse_keywords('  "" ') == ''
+
+
+#####################################
+# find_emails
+#####################################
+
+def test_find_emails_plain():
+    assert find_emails("Business: Bob@Yahoo.com, or bob@yahoo.com") == ["bob@yahoo.com"]
+    assert find_emails("no emails here") == []
+
+
+@pytest.mark.parametrize("description", [
+    "bob AT yahoo DOT com",
+    "bob [at] yahoo [dot] com",
+    "bob(at)yahoo(dot)com",
+    "bob {at} yahoo {dot} com",
+    "bob [ AT ] yahoo ( Dot ) com",
+    "bob@yahoo [dot] com",
+])
+def test_find_emails_obfuscated(description):
+    assert find_emails("Contact: " + description + " for business") == ["bob@yahoo.com"]
+
+
+@pytest.mark.parametrize("description", [
+    "Meet us (at) the park",
+    "meet me at the beach",
+    "We're [at] it again (dot) (dot) (dot)",
+])
+def test_find_emails_no_false_positives(description):
+    assert find_emails(description) == []
+
+
+def test_find_emails_keeps_written_out_emails_without_a_dot():
+    # Only the deobfuscated ones need a dot in the domain
+    assert find_emails("me@localhost (hi) and bob AT x DOT com") == ["bob@x.com", "me@localhost"]
+
+
+@pytest.mark.parametrize("description", [
+    "[" + " " * 40000,
+    "(at" + " " * 40000 + "x",
+    " AT" * 20000,
+    "[ " * 20000,
+    "a" * 40000 + "@",
+])
+def test_find_emails_linear_on_long_runs(description):
+    started = time.perf_counter()
+    find_emails(description)
+    assert time.perf_counter() - started < 1.0
+
+
+#####################################
+# channel_country
+#####################################
+
+def test_channel_country():
+    assert channel_country("US", "GB") == "US"
+    assert channel_country(None, "GB") == "GB"
+    assert channel_country("", None) == ""
@@ -0,0 +1,211 @@
+# Crawl benchmark: runs yt_influencers.py against the fake API server (yt_fake_api.py) on a generated keywords file
+# and a fresh database, and reports throughput, credits spent per new channel, DB write time, peak memory and how
+# much it downloaded.
+# For catching regressions and comparing crawl strategies without spending real quota.
+#
+# e.g.  python yt_bench.py --searches 40 --latency-ms 80 --modes sequential concurrent
+#       python yt_bench.py --modes sequential expand --expand-credits 2000   (new channels per credit, search vs expansion)
+#       python yt_bench.py --modes refresh --change-rate 0.1   (stats refresh with etags, a fake day after the last one)
+#       python yt_bench.py --error-rate 0.02 --results bench_results.jsonl   (appends one JSON line per run)
+
+import argparse
+import csv
+import json
+import os
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from yt_fake_api import FakeConfig, start_in_thread, WORDS
+
+#####################################
+# CONSTANTS
+#####################################
+CRAWLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "yt_influencers.py")
+
+# Crawl strategies to compare, as the crawler commands to run one after another on the same DB.  Only the last one
+# gets measured, the ones before it set it up (expansion needs channels to expand from).  A day passes on the fake
+# API before each command after the first, so some channels' statistics change in between.
+MODES = {
+    "sequential": [["crawl"]],
+    "concurrent": [["crawl", "--concurrent"]],
+    "expand": [["crawl"], ["expand"]],
+    "refresh": [["crawl"], ["refresh", "--min-age", "0"], ["refresh", "--min-age", "0"]],
+}
+
+COMMIT_LINE = re.compile(r"^Committed .* in ([0-9.]+)s$", re.MULTILINE)     # DbWriter's line for each commit
+REFRESHED_LINE = re.compile(r"Refreshed ([0-9]+) channels")                 # The refresh's summary line
+UNCHANGED_LINE = re.compile(r"channels in this run \(([0-9]+) unchanged\)")
+
+#####################################
+# Helper Functions
+#####################################
+
+def write_keywords_file(path, searches, seed):
+    # One search per row, half of them for videos and half for channels, using the "reviews" postfix column
+    rng = random.Random(seed)
+    keywords = set()
+    while len(keywords) < searches:
+        keywords.add(" ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))))
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(["keyword", "type", "best prefix", "reviews postfix", "unboxing postfix", "tips postfix", "advice postfix"])
+        for i, keyword in enumerate(sorted(keywords)):
+            writer.writerow([keyword, "videos" if i % 2 else "channels", "", "TRUE", "", "", ""])
+
+
+def peak_memory_mb(rusage):
+    # ru_maxrss is in KB on Linux but bytes on macOS
+    return rusage.ru_maxrss / (1024**2 if sys.platform == "darwin" else 1024)
+
+
+def db_counts(db_path):
+    # (searches, channels, credits spent) so far
+    if not os.path.exists(db_path):
+        return 0, 0, 0
+    db = sqlite3.connect(db_path)
+    searches = db.execute("SELECT COUNT(*) FROM Search").fetchone()[0]
+    channels = db.execute("SELECT COUNT(*) FROM Channel").fetchone()[0]
+    credits = db.execute("SELECT COALESCE(SUM(credits_used), 0) FROM QuotaLedger").fetchone()[0]
+    db.close()
+    return searches, channels, credits
+
+
+def run_crawler(mode, command_args, base_url, workdir, args):
+    # Runs one crawler command in the run's directory, returns (seconds, peak memory in MB, its output)
+    db_path = os.path.join(workdir, "bench.db")
+    log_path = os.path.join(workdir, f"{command_args[0]}.log")     # (the last one of each command's runs)
+    command = [
+        sys.executable, CRAWLER, *command_args,
+        "--db", f"sqlite:///{db_path}",
+        "--cache-dir", os.path.join(workdir, "response_cache"),
+        "--api-base-url", base_url,
+        "--min-interval", "0",
+        "--daily-quota", str(10**9),
+    ]
+    if command_args[0] == "crawl":
+        command += ["--keywords", os.path.join(workdir, "keywords.csv")]
+    if "--concurrent" in command_args:
+        command += ["--search-workers", str(args.search_workers), "--channel-workers", str(args.channel_workers)]
+    if command_args[0] == "expand":
+        command += ["--max-credits", str(args.expand_credits)]
+
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+        pid, status, rusage = os.wait4(process.pid, 0)     # wait4 to get this child's own peak memory
+        elapsed = time.perf_counter() - start
+
+    with open(log_path) as log:
+        output = log.read()
+    if os.waitstatus_to_exitcode(status) != 0:
+        print(output[-3000:])
+        raise SystemExit(f"Crawl ({mode}: {' '.join(command_args)}) failed, full log in {log_path}")
+    return elapsed, peak_memory_mb(rusage), output
+
+
+def run_crawl(mode, api, base_url, workdir, args):
+    # Runs one mode's commands in its own directory, returns a dict of results for the last one
+    db_path = os.path.join(workdir, "bench.db")
+    for i, command_args in enumerate(MODES[mode][:-1]):
+        if i:
+            api.advance()
+        run_crawler(mode, command_args, base_url, workdir, args)
+    if len(MODES[mode]) > 1:
+        api.advance()
+
+    # Only count what the last command did
+    searches_before, channels_before, credits_before = db_counts(db_path)
+    requests_before, bytes_before, not_modified_before = api.requests, api.bytes_sent, api.not_modified
+    elapsed, peak_mb, output = run_crawler(mode, MODES[mode][-1], base_url, workdir, args)
+    searches, channels, credits = db_counts(db_path)
+    searches, channels, credits = searches - searches_before, channels - channels_before, credits - credits_before
+
+    return {
+        "mode": mode,
+        "seconds": elapsed,
+        "searches": searches,
+        "channels": channels,
+        "credits": credits,
+        "refreshed": sum(int(x) for x in REFRESHED_LINE.findall(output)),
+        "unchanged": sum(int(x) for x in UNCHANGED_LINE.findall(output)),
+        "searches_per_second": searches / elapsed,
+        "channels_per_second": channels / elapsed,
+        "credits_per_new_channel": credits / channels if channels else None,
+        "new_channels_per_100_credits": 100 * channels / credits if credits else None,
+        "db_write_seconds": sum(float(x) for x in COMMIT_LINE.findall(output)),
+        "peak_memory_mb": peak_mb,
+        "api_requests": api.requests - requests_before,
+        "api_not_modified": api.not_modified - not_modified_before,
+        "api_mb": (api.bytes_sent - bytes_before) / 1024**2,
+    }
+
+
+def print_report(results):
+    print("")
+    print("{0:<12} {1:>8} {2:>9} {3:>10} {4:>10} {5:>12} {6:>12} {7:>9} {8:>9} {9:>8} {10:>8}".format(
+        "mode", "seconds", "searches", "channels", "searches/s", "channels/s", "credits/new", "new/100cr", "db write", "peak MB", "API MB"))
+    for r in results:
+        print("{0:<12} {1:>8.2f} {2:>9d} {3:>10d} {4:>10.2f} {5:>12.1f} {6:>12.3f} {7:>9.1f} {8:>8.3f}s {9:>8.1f} {10:>8.1f}".format(
+            r["mode"], r["seconds"], r["searches"], r["channels"], r["searches_per_second"], r["channels_per_second"],
+            r["credits_per_new_channel"] or 0, r["new_channels_per_100_credits"] or 0, r["db_write_seconds"], r["peak_memory_mb"], r["api_mb"]))
+    for r in results:
+        if r["refreshed"]:
+            print(f"{r['mode']}: refreshed {r['refreshed']} channels, {r['unchanged']} unchanged, "
+                  f"{r['api_not_modified']} of {r['api_requests']} requests not modified (304)")
+
+
+#####################################
+# Main
+#####################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the crawler against the fake YouTube API.")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES), default=list(MODES), help="Crawl strategies to run")
+    parser.add_argument("--searches", type=int, default=40, help="Number of searches in the generated keywords file")
+    parser.add_argument("--search-workers", type=int, default=2)
+    parser.add_argument("--channel-workers", type=int, default=2)
+    parser.add_argument("--expand-credits", type=int, default=2000, help="Credits the expand mode's expansion gets to spend (after its crawl)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--universe", type=int, default=20000, help="Number of distinct channels on the fake API")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Mean fake API latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 503 responses")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="Fraction of 403 quotaExceeded responses")
+    parser.add_argument("--missing-rate", type=float, default=0.02, help="Fraction of deleted channels")
+    parser.add_argument("--change-rate", type=float, default=0.1, help="Fraction of channels whose statistics change each fake day")
+    parser.add_argument("--results", help="Append each run's results as a JSON line to this file")
+    parser.add_argument("--keep", action="store_true", help="Keep the working directories (DB, log, cache) of each run")
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes:
+        # Fresh server for each run, so they all see exactly the same API
+        config = FakeConfig(seed=args.seed, universe=args.universe, latency_ms=args.latency_ms, error_rate=args.error_rate,
+                            quota_error_rate=args.quota_error_rate, missing_rate=args.missing_rate, change_rate=args.change_rate)
+        server, api, base_url = start_in_thread(config)
+
+        workdir = tempfile.mkdtemp(prefix=f"yt_bench_{mode}_")
+        write_keywords_file(os.path.join(workdir, "keywords.csv"), args.searches, args.seed)
+        print(f"Running {mode} crawl of {args.searches} searches in {workdir} ...")
+        result = run_crawl(mode, api, base_url, workdir, args)
+        server.shutdown()
+        server.server_close()
+        results.append(result)
+
+        if args.results:
+            with open(args.results, 'a') as f:
+                f.write(json.dumps(dict(result, timestamp=time.time(), config=vars(args))) + "\n")
+        if not args.keep:
+            shutil.rmtree(workdir)
+
+    print_report(results)
+
+
+if __name__ == "__main__":
+    main()
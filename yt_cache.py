@@ -0,0 +1,172 @@
+# On-disk cache of YouTube API responses, so the crawl can be re-run (e.g. after changing the parsing or the
+# DB schema) without spending quota again.  See yt_influencers.py --replay.
+#
+# Responses are stored gzipped, one file per request, named by the SHA-256 of the normalized request URL (the URL
+# without the API key, with its parameters in a fixed order), e.g. response_cache/3f/3fa4...e1.json.gz
+# Channel lookups are cached one channel per entry, not per batch, since the batches come out different every run.
+# Expired entries aren't deleted: their etag lets the next request for the same URL ask the API for it only if it
+# changed (If-None-Match, see peek() and yt_influencers.py's api_get_revalidated()).
+# The total size of the entries is kept in a small SQLite table next to them (SIZE_DB), which every process using the
+# cache (e.g. crawl workers) adds to as it puts, so starting up doesn't have to go through every file to get it.
+
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+#####################################
+# CONSTANTS
+#####################################
+CACHE_DIR = "response_cache"
+
+DAY = 24 * 60 * 60
+CACHE_TTLS = {                  # seconds, by endpoint
+    "search": 28 * DAY,         # Search results barely change
+    "channels": 1 * DAY,        # Channel statistics do
+}
+DEFAULT_TTL = 1 * DAY
+
+CACHE_MAX_BYTES = 10 * 1024**3  # Oldest (least recently used) entries get evicted past this size
+EVICT_TO = 0.9                  # and it evicts down to this fraction of it, so it doesn't evict on every put
+
+IGNORED_PARAMS = {"key"}        # Don't key on (or store) the API key
+
+SIZE_DB = "size.db"             # In the cache directory, the running total of the entries' sizes
+
+#####################################
+# Cache
+#####################################
+
+class ResponseCache:
+
+    def __init__(self, directory=CACHE_DIR, ttls=CACHE_TTLS, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.ttls = ttls
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()    # For total_bytes and size_db, puts can come from the concurrent crawl's threads
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.size_db = sqlite3.connect(os.path.join(self.directory, SIZE_DB), timeout=60, isolation_level=None, check_same_thread=False)
+        self.size_db.execute("PRAGMA journal_mode=WAL")
+        self.size_db.execute("PRAGMA synchronous=NORMAL")
+        self.size_db.execute("CREATE TABLE IF NOT EXISTS CacheSize (id INTEGER PRIMARY KEY CHECK (id = 1), total_bytes INTEGER NOT NULL)")
+        row = self.size_db.execute("SELECT total_bytes FROM CacheSize").fetchone()
+        if row is None:
+            # A cache from before the total was kept (or a new one), add it up this once
+            total = sum(size for (mtime, size, path) in self.entries())
+            self.size_db.execute("INSERT OR IGNORE INTO CacheSize (id, total_bytes) VALUES (1, ?)", (total,))
+            row = self.size_db.execute("SELECT total_bytes FROM CacheSize").fetchone()
+        self.total_bytes = row[0]
+
+    def normalize(self, url):
+        # e.g. "https://www.googleapis.com/youtube/v3/search?part=snippet&q=best%20cooktops&key=xxx"
+        #   -> "search?part=snippet&q=best+cooktops"
+        parts = urlsplit(url)
+        endpoint = parts.path.rstrip('/').rsplit('/', 1)[-1]
+        params = sorted((k, v) for (k, v) in parse_qsl(parts.query, keep_blank_values=True) if k not in IGNORED_PARAMS)
+        return f"{endpoint}?{urlencode(params)}"
+
+    def path(self, key):
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest + ".json.gz")
+
+    def load(self, key):
+        # The entry for a normalized URL, or None
+        try:
+            with gzip.open(self.path(key), 'rt', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, EOFError, OSError, ValueError):
+            # Not there, or a partial/corrupt file, either way a miss
+            return None
+        return entry if entry['key'] == key else None
+
+    def get(self, url, ignore_ttl=False):
+        # Returns the cached JSON response for url, or None if it isn't cached (or has expired, unless ignore_ttl)
+        key = self.normalize(url)
+        path = self.path(key)
+        entry = self.load(key)
+
+        endpoint = key.split('?', 1)[0]
+        if entry is None or (not ignore_ttl and time.time() - entry['fetched_at'] > self.ttls.get(endpoint, DEFAULT_TTL)):
+            self.misses += 1
+            return None
+
+        # Touch it, so eviction goes by last use
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return entry['response']
+
+    def peek(self, url):
+        # The cached response for url however old it is, or None.  For revalidating it with the API (by its etag),
+        # so it doesn't count as a hit or a miss.
+        entry = self.load(self.normalize(url))
+        return entry['response'] if entry is not None else None
+
+    def put(self, url, json_response):
+        key = self.normalize(url)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temp file and move it into place, so a crash never leaves a half-written entry
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+            json.dump({'key': key, 'fetched_at': time.time(), 'response': json_response}, f, separators=(',', ':'))
+        size = os.path.getsize(tmp_path)
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.add_bytes(size - old_size)
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def add_bytes(self, num_bytes):
+        # Add to the shared total, and read it back to keep up with what other processes put too
+        self.size_db.execute("BEGIN IMMEDIATE")
+        try:
+            self.size_db.execute("UPDATE CacheSize SET total_bytes = total_bytes + ?", (num_bytes,))
+            self.total_bytes = self.size_db.execute("SELECT total_bytes FROM CacheSize").fetchone()[0]
+        finally:
+            self.size_db.execute("COMMIT")
+
+    def entries(self):
+        # (mtime, size, path) of every entry
+        for sub in os.scandir(self.directory):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.endswith(".json.gz"):
+                    stat = entry.stat()
+                    yield stat.st_mtime, stat.st_size, entry.path
+
+    def evict(self):
+        # Delete the least recently used entries until it's back down to EVICT_TO of max_bytes.  Goes through every
+        # entry anyway, so it also sets the total to what's really there (e.g. if entries were deleted by hand).
+        target = self.max_bytes * EVICT_TO
+        evicted = 0
+        entries = sorted(self.entries())
+        self.total_bytes = sum(size for (mtime, size, path) in entries)
+        for mtime, size, path in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.total_bytes -= size
+            evicted += 1
+        self.size_db.execute("UPDATE CacheSize SET total_bytes = ?", (self.total_bytes,))
+        print(f"Evicted {evicted} responses from the cache, now {self.total_bytes / 1024**2:.0f} MB.")
@@ -0,0 +1,331 @@
+# Streams the Channel or Search table out of the crawl database to Parquet, JSON lines or CSV, for analytics jobs.
+# Rows are read through one cursor a chunk at a time and written out as they come, so memory stays flat however big
+# the table is.  Filters are applied in the SQL query, not after reading.
+#
+# e.g.  python yt_export.py --table channel --format parquet --output channels.parquet --country US --min-subs 10000
+#       python yt_export.py --table channel --format jsonl --output changed.jsonl --incremental nightly
+#
+# --incremental NAME only exports the rows that changed since the last export with that NAME, and then moves NAME's
+# watermark up (only once the export has finished, so a failed export just gets redone next time).  Channels know
+# when they last changed from Channel.updated_at, which triggers set on every insert/update of the channel's data or
+# its keyword tags (see create_change_tracking(), which the crawler calls at startup).  A stats refresh that finds a
+# channel unchanged (same etag) only marks it as read, which doesn't count.  Searches only ever get added,
+# so for them it's just the highest id exported.
+#
+# Parquet needs pyarrow (pip install pyarrow), JSON lines and CSV don't need anything extra.
+
+import argparse
+import csv
+import json
+import time
+
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import create_engine, inspect, text
+
+from yt_query import DB_URL
+
+#####################################
+# CONSTANTS
+#####################################
+CHUNK_SIZE = 10000          # Rows per fetch (and per Parquet row group)
+FORMATS = ("parquet", "jsonl", "csv")
+TABLES = ("channel", "search")
+
+# Rows changed in the last few minutes wait for the next incremental export, so that nothing from a write that was
+# still in progress when the export started gets skipped (see export())
+CHANGE_LAG = timedelta(minutes=5)
+
+LIST_SEPARATOR = ","        # Lists are comma separated in the DB (potential_contact_emails) and in CSV, keywords never have commas
+
+# The Channel columns that count as the channel changing.  Not the bookkeeping ones (stats_updated_at, expanded_at,
+# etag, stats_etag), which the crawler also updates when nothing about the channel changed.
+TRACKED_COLUMNS = ("channel_id", "title", "description", "thumb_default", "thumb_med", "thumb_high", "published_at",
+                   "custom_url", "default_language", "country", "view_count", "subscriber_count", "video_count",
+                   "subscriber_growth", "made_for_kids", "potential_contact_emails", "branding_keywords",
+                   "snippet_country", "branding_country")
+
+# Keeps Channel.updated_at current, the same way yt_query.py keeps the search index current
+CHANGE_TRACKING_DDL = [
+    """CREATE INDEX IF NOT EXISTS ix_Channel_updated_at ON Channel (updated_at)""",
+    """CREATE TABLE IF NOT EXISTS ExportWatermark (
+        name VARCHAR(64) PRIMARY KEY,
+        watermark VARCHAR(32),      -- Channel.updated_at (or Search.id) up to which it's been exported
+        exported_at VARCHAR(32)
+    )""",
+    """CREATE TRIGGER IF NOT EXISTS Channel_updated_at_insert AFTER INSERT ON Channel BEGIN
+        UPDATE Channel SET updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE id = new.id;
+    END""",
+    # Unless the update set updated_at itself (which includes this trigger's own update).  Older versions fired on
+    # updates of any column.
+    """DROP TRIGGER IF EXISTS Channel_updated_at_update""",
+    f"""CREATE TRIGGER IF NOT EXISTS Channel_updated_at_data_update AFTER UPDATE OF {", ".join(TRACKED_COLUMNS)} ON Channel
+    WHEN new.updated_at IS old.updated_at BEGIN
+        UPDATE Channel SET updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE id = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS Channel_updated_at_keyword_insert AFTER INSERT ON ChannelKeyword BEGIN
+        UPDATE Channel SET updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE id = new.channel_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS Channel_updated_at_keyword_delete AFTER DELETE ON ChannelKeyword BEGIN
+        UPDATE Channel SET updated_at = strftime('%Y-%m-%dT%H:%M:%fZ', 'now') WHERE id = old.channel_id;
+    END""",
+]
+
+# What gets exported from each table: (column name, SQL expression, type).  Types are "int", "float", "bool",
+# "string", "timestamp" (our UTC ISO 8601 strings) and "list" (strings).
+KEYWORDS_SQL = """(SELECT group_concat(Keyword.keyword) FROM ChannelKeyword JOIN Keyword ON Keyword.id = ChannelKeyword.keyword_id
+                   WHERE ChannelKeyword.channel_id = Channel.id AND ChannelKeyword.source = '{source}')"""
+CHANNEL_COLUMNS = (
+    ("id",                          "Channel.id",                       "int"),
+    ("channel_id",                  "Channel.channel_id",               "string"),
+    ("title",                       "Channel.title",                    "string"),
+    ("description",                 "Channel.description",              "string"),
+    ("custom_url",                  "Channel.custom_url",               "string"),
+    ("country",                     "Channel.country",                  "string"),
+    ("default_language",            "Channel.default_language",         "string"),
+    ("published_at",                "Channel.published_at",             "timestamp"),
+    ("view_count",                  "Channel.view_count",               "int"),
+    ("subscriber_count",            "Channel.subscriber_count",         "int"),
+    ("video_count",                 "Channel.video_count",              "int"),
+    ("subscriber_growth",           "Channel.subscriber_growth",        "float"),
+    ("made_for_kids",               "Channel.made_for_kids",            "bool"),
+    ("potential_contact_emails",    "Channel.potential_contact_emails", "list"),
+    ("creator_keywords",            KEYWORDS_SQL.format(source="creator"), "list"),
+    ("search_keywords",             KEYWORDS_SQL.format(source="search"),  "list"),
+    ("thumb_default",               "Channel.thumb_default",            "string"),
+    ("thumb_med",                   "Channel.thumb_med",                "string"),
+    ("thumb_high",                  "Channel.thumb_high",               "string"),
+    ("stats_updated_at",            "Channel.stats_updated_at",         "timestamp"),
+    ("updated_at",                  "Channel.updated_at",               "timestamp"),
+    ("etag",                        "Channel.etag",                     "string"),
+)
+SEARCH_COLUMNS = (
+    ("id",                          "Search.id",                        "int"),
+    ("search",                      "Search.search",                    "string"),
+    ("num_results",                 "Search.num_results",               "int"),
+    ("etag",                        "Search.etag",                      "string"),
+)
+
+#####################################
+# Helper Functions
+#####################################
+
+def create_change_tracking(engine):
+    # Add Channel.updated_at, its triggers and the watermark table if they aren't there yet.  Safe to call every
+    # time the crawler or this script starts.  Channels that haven't changed since have updated_at NULL, they only
+    # come out of full exports.
+    if 'updated_at' not in { column['name'] for column in inspect(engine).get_columns("Channel") }:
+        with engine.begin() as conn:
+            conn.exec_driver_sql('ALTER TABLE "Channel" ADD COLUMN "updated_at" VARCHAR(32)')
+    with engine.begin() as conn:
+        for statement in CHANGE_TRACKING_DDL:
+            conn.exec_driver_sql(statement)
+
+
+def channel_filters(country=None, min_subscribers=None, max_subscribers=None, made_for_kids=None, has_email=False, keyword=None):
+    # SQL conditions (and their parameters) for the channel filters, same as yt_query.py's
+    where = []
+    params = {}
+    if country:
+        where.append("Channel.country = :country")
+        params['country'] = country.upper()
+    if min_subscribers is not None:
+        where.append("Channel.subscriber_count >= :min_subscribers")
+        params['min_subscribers'] = min_subscribers
+    if max_subscribers is not None:
+        where.append("Channel.subscriber_count <= :max_subscribers")
+        params['max_subscribers'] = max_subscribers
+    if made_for_kids is not None:
+        where.append("Channel.made_for_kids = :made_for_kids")
+        params['made_for_kids'] = made_for_kids
+    if has_email:
+        where.append("Channel.potential_contact_emails != ''")
+    if keyword:
+        where.append("""EXISTS (SELECT 1 FROM ChannelKeyword JOIN Keyword ON Keyword.id = ChannelKeyword.keyword_id
+                                WHERE ChannelKeyword.channel_id = Channel.id AND Keyword.keyword = :keyword)""")
+        params['keyword'] = keyword.lower()
+    return where, params
+
+
+def parse_timestamp(value):
+    # Our UTC ISO 8601 strings, e.g. "2020-07-04T18:30:00Z" or "2020-07-04T18:30:00.123Z".  fromisoformat() only
+    # takes the Z from Python 3.11 on.
+    return datetime.fromisoformat(value.replace('Z', '+00:00')) if value else None
+
+
+def convert_column(values, type):
+    # A column of raw DB values as Python values of its type
+    if type == "list":
+        return [ [ x for x in value.split(LIST_SEPARATOR) if x ] if value else [] for value in values ]
+    if type == "bool":
+        return [ None if value is None else bool(value) for value in values ]
+    return values
+
+
+class ParquetOutput:
+    # Each chunk is one row group.  pyarrow only gets imported here, so the other formats don't need it.
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit("Parquet export needs pyarrow (pip install pyarrow), or use --format jsonl/csv")
+        self.pa = pyarrow
+        types = {"int": pyarrow.int64(), "float": pyarrow.float64(), "bool": pyarrow.bool_(), "string": pyarrow.string(),
+                 "timestamp": pyarrow.timestamp('ms', tz='UTC'), "list": pyarrow.list_(pyarrow.string())}
+        self.columns = columns
+        self.schema = pyarrow.schema([ (name, types[type]) for (name, sql, type) in columns ])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='zstd')
+
+    def write(self, rows):
+        arrays = []
+        for i, (name, sql, type) in enumerate(self.columns):
+            values = [ row[i] for row in rows ]
+            if type == "timestamp":
+                values = [ parse_timestamp(value) for value in values ]
+            arrays.append(self.pa.array(convert_column(values, type), type=self.schema.field(name).type))
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+
+class JsonlOutput:
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', encoding='utf-8')
+        self.columns = columns
+
+    def write(self, rows):
+        names = [ name for (name, sql, type) in self.columns ]
+        columns = [ convert_column([ row[i] for row in rows ], type)
+                    for i, (name, sql, type) in enumerate(self.columns) ]
+        for values in zip(*columns):
+            self.file.write(json.dumps(dict(zip(names, values)), ensure_ascii=False) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+class CsvOutput:
+    # Lists are already comma separated straight out of the DB
+
+    def __init__(self, path, columns):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow([ name for (name, sql, type) in columns ])
+
+    def write(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+OUTPUTS = {"parquet": ParquetOutput, "jsonl": JsonlOutput, "csv": CsvOutput}
+
+
+def export(engine, table, format, path, where=(), params=None, incremental=None, chunk_size=CHUNK_SIZE):
+    # Export table ("channel" or "search") to path, with only the rows matching the SQL conditions in where.
+    # With incremental=NAME, only the ones that changed since the last export with that NAME.  Returns the row count.
+    where = list(where)
+    params = dict(params or {})
+    columns = CHANNEL_COLUMNS if table == "channel" else SEARCH_COLUMNS
+
+    with engine.connect() as conn:
+        # One read transaction for the whole export, so it's all from the same snapshot of the DB
+        conn.exec_driver_sql("BEGIN")
+
+        watermark = None
+        if incremental:
+            previous = conn.execute(text("SELECT watermark FROM ExportWatermark WHERE name = :name"), {'name': incremental}).scalar()
+            if table == "channel":
+                # Up to CHANGE_LAG ago, since a write that started before this export (and so isn't in its snapshot)
+                # can commit rows with a timestamp from before it
+                watermark = (datetime.now(timezone.utc) - CHANGE_LAG).strftime('%Y-%m-%dT%H:%M:%S.%fZ')[:-4] + 'Z'
+                params['watermark'] = watermark
+                if previous:
+                    where.append("Channel.updated_at > :since AND Channel.updated_at <= :watermark")
+                    params['since'] = previous
+                else:
+                    # The first export also gets the channels that haven't changed since before there were triggers
+                    where.append("(Channel.updated_at IS NULL OR Channel.updated_at <= :watermark)")
+            else:
+                watermark = str(conn.execute(text("SELECT COALESCE(MAX(id), 0) FROM Search")).scalar())
+                where.append("Search.id <= :watermark")
+                params['watermark'] = int(watermark)
+                if previous:
+                    where.append("Search.id > :since")
+                    params['since'] = int(previous)
+            print(f"Exporting {table} rows changed since {previous or 'the beginning'} (up to {watermark})")
+
+        sql = f"""
+            SELECT {", ".join(expression for (name, expression, type) in columns)}
+            FROM {"Channel" if table == "channel" else "Search"}
+            {"WHERE " + " AND ".join(where) if where else ""}
+        """
+
+        output = OUTPUTS[format](path, columns)
+        count = 0
+        try:
+            result = conn.execute(text(sql), params)
+            while True:
+                rows = result.fetchmany(chunk_size)     # The sqlite3 cursor steps through the query as it goes, nothing else is held
+                if not rows:
+                    break
+                output.write(rows)
+                count += len(rows)
+                print(f"  ..{count} rows")
+        finally:
+            output.close()
+        conn.exec_driver_sql("COMMIT")
+
+    # Only once the whole export is written
+    if incremental:
+        with engine.begin() as conn:
+            conn.execute(text("""INSERT INTO ExportWatermark (name, watermark, exported_at) VALUES (:name, :watermark, :now)
+                                 ON CONFLICT (name) DO UPDATE SET watermark = excluded.watermark, exported_at = excluded.exported_at"""),
+                         {'name': incremental, 'watermark': watermark, 'now': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')})
+    return count
+
+
+#####################################
+# Main
+#####################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the crawled channels or searches to Parquet, JSON lines or CSV.")
+    parser.add_argument("--table", choices=TABLES, default="channel")
+    parser.add_argument("--format", choices=FORMATS, default="parquet")
+    parser.add_argument("--output", help="Output file (default <table>.<format>)")
+    parser.add_argument("--incremental", metavar="NAME",
+                        help="Only export the rows that changed since the last export with this name, e.g. nightly")
+    # Channel filters
+    parser.add_argument("--country", help="Two letter country code, e.g. US")
+    parser.add_argument("--min-subs", type=int, help="Minimum subscriber count")
+    parser.add_argument("--max-subs", type=int, help="Maximum subscriber count")
+    parser.add_argument("--no-kids", action="store_true", help="Leave out channels that are made for kids")
+    parser.add_argument("--has-email", action="store_true", help="Only channels with a potential contact email")
+    parser.add_argument("--keyword", help="Only channels tagged with this keyword")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help=f"Rows per chunk (default {CHUNK_SIZE})")
+    parser.add_argument("--db", default=DB_URL, help=f"Database URL (default {DB_URL})")
+    args = parser.parse_args(argv)
+
+    engine = create_engine(args.db, connect_args={'timeout': 60})
+    create_change_tracking(engine)
+
+    if args.table == "channel":
+        where, params = channel_filters(country=args.country, min_subscribers=args.min_subs, max_subscribers=args.max_subs,
+                                        made_for_kids=(False if args.no_kids else None), has_email=args.has_email, keyword=args.keyword)
+    else:
+        where, params = [], {}
+
+    start = time.perf_counter()
+    path = args.output or f"{args.table}.{args.format}"
+    count = export(engine, args.table, args.format, path, where, params, args.incremental, args.chunk_size)
+    print(f"Exported {count} {args.table} rows to {path} in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
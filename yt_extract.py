@@ -0,0 +1,69 @@
+# The fields we work out from a channel's raw data (its keywords, contact emails and country), shared by the crawler
+# (yt_influencers.py) when it saves a channel and by yt_reprocess.py when it re-derives them for the channels already
+# in the database.  Everything here is linear in the length of the text, with the regexes compiled once.
+
+import re
+
+#####################################
+# CONSTANTS
+#####################################
+
+# Emails written out normally, e.g. bob@yahoo.com.  The lookbehind only lets a match start at the beginning of a
+# run of email characters, so a long run with no @ in it gets scanned once instead of once from every character.
+EMAIL_RE = re.compile(r'(?<![\w.%+-])[\w.%+-]+@[\w.-]+')
+
+# Ways people hide their email from scrapers, which get turned back into @ and . before looking for emails:
+#   bob AT yahoo DOT com,  bob [at] yahoo [dot] com,  bob(at)yahoo(dot)com,  bob {at} yahoo {dot} com
+# Spelled out with spaces only counts in capitals (AT/DOT), otherwise any "meet me at the beach" would match.
+# These only match the token itself (without the whitespace around it), so every match starts at a bracket or at
+# the A/D, and gets swapped for a placeholder character that SPACED_RE then turns into @ or . along with the
+# whitespace around it.  The lookbehind there only lets a match start at the beginning of a run of whitespace, so
+# a long run gets scanned once instead of once from every character.
+AT_RE = re.compile(r'[\[({]\s*(?i:at)\s*[\])}]|(?<=\s)AT(?=\s)')
+DOT_RE = re.compile(r'[\[({]\s*(?i:dot)\s*[\])}]|(?<=\s)DOT(?=\s)')
+AT_PLACEHOLDER, DOT_PLACEHOLDER = '\x00', '\x01'
+SPACED_RE = re.compile(r'(?<!\s)\s*([\x00\x01])\s*')
+OBFUSCATION_HINTS = ("AT", "DOT", "[", "(", "{")     # Most descriptions have none of these, so skip the regexes for them
+
+#####################################
+# Helper Functions
+#####################################
+
+def parse_keywords(text, search_keyword=None):
+    # Split the keywords into comma-separated list, but need to keep the words between " " tokenized
+    # e.g. 'surfing "how to surf" hawaii' -> "surfing,how to surf,hawaii" (in no particular order)
+    # Splitting on the quotes leaves the quoted parts at the odd indexes, and only the spaces in between those
+    # separate keywords.  (Same result as going through it a character at a time, which gets slow on long strings)
+    parts = text.lower().split('"')
+    parts[0::2] = [ part.replace(' ', ',') for part in parts[0::2] ]
+
+    # Lastly, in case there are duplicate tags, remove them by creating a set, then converting back to string
+    out_list = set(''.join(parts).split(','))
+    if search_keyword is not None:
+        out_list.add(search_keyword)            # Add in the keyword from our search
+    out_list.discard('')
+    return ','.join(out_list)                   # Turn back to comma separated string
+
+
+def deobfuscate(text):
+    # Turn the spelled-out @s and .s back into real ones, e.g. "bob [at] yahoo [dot] com" -> "bob@yahoo.com"
+    text = text.replace(AT_PLACEHOLDER, '').replace(DOT_PLACEHOLDER, '')
+    text = DOT_RE.sub(DOT_PLACEHOLDER, AT_RE.sub(AT_PLACEHOLDER, text))
+    return SPACED_RE.sub(lambda m: '@' if m.group(1) == AT_PLACEHOLDER else '.', text)
+
+
+def find_emails(description):
+    # Potential contact emails in a channel description (no way to get them through the API), lowercased, sorted and
+    # without duplicates.  Spelled-out ones (see AT_RE) come back as normal emails, but only if their domain has a
+    # dot in it, so e.g. "meet us (at) the park" doesn't turn into us@the.
+    emails = set(EMAIL_RE.findall(description)) if '@' in description else set()
+    if any(hint in description for hint in OBFUSCATION_HINTS):
+        written_out = emails
+        emails = { email for email in EMAIL_RE.findall(deobfuscate(description))
+                   if email in written_out or '.' in email.split('@', 1)[1].strip('.') }
+    return sorted({ email.lower() for email in emails })
+
+
+def channel_country(snippet_country, branding_country):
+    # The channel's country can be in two different places (snippet, and possibly in brandingSettings)
+    return snippet_country or branding_country or ''    # The OR will take if only one set, prioritize snippet if both set
@@ -0,0 +1,480 @@
+# Local stand-in for the YouTube Data API's search and channels endpoints (plus the channelSections, playlists,
+# playlistItems and commentThreads listings that discovery expansion uses), for exercising and benchmarking
+# yt_influencers.py without an API key or spending real quota.  See yt_bench.py.
+#
+# Responses look like the real youtube#searchListResponse / youtube#channelListResponse etc payloads, generated from
+# a seed, so the same query always returns the same channels.  Latency, server errors, 403 quota errors and a daily
+# quota are all configurable.
+# Channel statistics change a "day" at a time (see FakeYouTube.advance()), for change_rate of the channels each day,
+# and etags follow the content, including which parts and fields were asked for: a request with If-None-Match the
+# current etag gets 304 Not Modified, like the real API.
+# Channels link to other channels (featured channels, channel sections, other creators' videos in their playlists)
+# and get comments from viewers, most of whom have a channel with nothing on it.
+#
+# e.g.  python yt_fake_api.py --port 8765 --latency-ms 80 --error-rate 0.01
+#       python yt_influencers.py --api-base-url http://127.0.0.1:8765/youtube/v3/ --min-interval 0 --db sqlite:///fake.db
+
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+#####################################
+# CONSTANTS
+#####################################
+DEFAULT_PORT = 8765
+API_PATH = "/youtube/v3/"
+
+# Same as the real API
+SEARCH_COST = 100
+CHANNEL_COST = 1
+LIST_COST = 1           # channelSections, playlists, playlistItems, commentThreads
+MAX_RESULTS = 50
+MAX_COMMENT_RESULTS = 100
+ENDPOINTS = ("search", "channels", "channelSections", "playlists", "playlistItems", "commentThreads")
+
+COMMENTER_VIEWER_RATE = 0.8     # Commenters that are viewers, not channels in the universe
+
+WORDS = ("surf surfing wave board beach tips review reviews unboxing best guide diy tech gaming cooking recipe "
+         "travel vlog music guitar drums fitness workout yoga appliances kitchen cooktops printing 3d printer "
+         "drone camera photo edit tutorial science space cars repair garden tools woodworking knife fishing").split()
+COUNTRIES = ["US", "US", "US", "GB", "CA", "AU", "IN", "DE", "BR", ""]
+EMAIL_DOMAINS = ["gmail.com", "yahoo.com", "outlook.com", "mychannel.tv"]
+
+#####################################
+# Fake API
+#####################################
+
+class FakeConfig:
+    # Everything about how the fake API behaves
+
+    def __init__(self, seed=0, universe=100000, latency_ms=0.0, error_rate=0.0, quota_error_rate=0.0,
+                 missing_rate=0.02, daily_quota=None, total_results=1000000, change_rate=0.1):
+        self.seed = seed
+        self.universe = universe                    # How many different channels searches can turn up
+        self.latency_ms = latency_ms                # Mean response time, exponentially distributed
+        self.error_rate = error_rate                # Fraction of requests that get a 500/503
+        self.quota_error_rate = quota_error_rate    # Fraction of requests that get a 403 quotaExceeded
+        self.missing_rate = missing_rate            # Fraction of channels that are deleted (left out of channels.list)
+        self.daily_quota = daily_quota              # If set, 403 quotaExceeded for everything once this is spent
+        self.total_results = total_results          # pageInfo.totalResults for searches
+        self.change_rate = change_rate              # Fraction of channels whose statistics change each day, see advance()
+
+
+class FakeYouTube:
+    # The generator and the bookkeeping, separate from the HTTP side
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.rng = random.Random(config.seed)       # For latency/errors only, responses are seeded per request
+        self.credits_used = 0
+        self.requests = 0
+        self.bytes_sent = 0                         # Response bodies, for comparing how much different requests download
+        self.not_modified = 0                       # 304s sent
+        self.day = 0                                # See advance()
+        self.numbers = None                         # channel_id -> n, for the channels in the universe, see channel_number()
+
+    def seeded(self, *parts):
+        digest = hashlib.sha256("|".join(str(p) for p in (self.config.seed,) + parts).encode()).digest()
+        return random.Random(int.from_bytes(digest[:8], 'big'))
+
+    def etag(self, *parts):
+        return hashlib.sha1("|".join(str(p) for p in parts).encode()).hexdigest()[:27]
+
+    def channel_id(self, n):
+        # Real channel ids are "UC" + 22 url-safe base64 characters
+        return "UC" + hashlib.sha256(f"{self.config.seed}-channel-{n}".encode()).hexdigest()[:22]
+
+    def channel_number(self, channel_id):
+        # n of a channel in the universe, or None for a viewer's channel (see commentThreads())
+        with self.lock:
+            if self.numbers is None:
+                self.numbers = { self.channel_id(n): n for n in range(self.config.universe) }
+        return self.numbers.get(channel_id)
+
+    def related_channel(self, rng):
+        # Channels link to popular channels a lot more than to the long tail, same as search results
+        if rng.random() < 0.5:
+            return self.channel_id(min(int(rng.paretovariate(1.1)) - 1, self.config.universe - 1))
+        return self.channel_id(rng.randrange(self.config.universe))
+
+    def thumbnails(self, base):
+        return {
+            "default": {"url": f"https://yt3.ggpht.com/{base}=s88-c-k-c0x00ffffff-no-rj", "width": 88, "height": 88},
+            "medium": {"url": f"https://yt3.ggpht.com/{base}=s240-c-k-c0x00ffffff-no-rj", "width": 240, "height": 240},
+            "high": {"url": f"https://yt3.ggpht.com/{base}=s800-c-k-c0x00ffffff-no-rj", "width": 800, "height": 800},
+        }
+
+    def advance(self, days=1):
+        # Let some days pass, in which change_rate of the channels get new statistics each day
+        with self.lock:
+            self.day += days
+
+    def charge(self, cost):
+        # Returns False if this request is over the daily quota
+        with self.lock:
+            self.requests += 1
+            if self.config.daily_quota is not None and self.credits_used + cost > self.config.daily_quota:
+                return False
+            self.credits_used += cost
+            return True
+
+    def search(self, params):
+        query = params.get('q', [''])[0]
+        search_type = params.get('type', ['video'])[0]
+        page_token = params.get('pageToken', [''])[0]
+        max_results = min(int(params.get('maxResults', ['5'])[0]), MAX_RESULTS)
+        page = int(page_token[len("PAGE"):]) if page_token.startswith("PAGE") else 0
+
+        rng = self.seeded("search", query, search_type, page)
+        items = []
+        for i in range(max_results):
+            # Popular channels show up much more often than the long tail
+            n = min(int(rng.paretovariate(1.1)) - 1, self.config.universe - 1) if rng.random() < 0.5 else rng.randrange(self.config.universe)
+            channel_id = self.channel_id(n)
+            title = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 6))).title()
+            published = f"20{rng.randint(10, 23)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T{rng.randint(0, 23):02d}:00:00Z"
+            if search_type == "channel":
+                item_id = {"kind": "youtube#channel", "channelId": channel_id}
+            else:
+                item_id = {"kind": "youtube#video", "videoId": hashlib.md5(f"{query}{page}{i}".encode()).hexdigest()[:11]}
+            items.append({
+                "kind": "youtube#searchResult",
+                "etag": self.etag("searchResult", query, page, i),
+                "id": item_id,
+                "snippet": {
+                    "publishedAt": published,
+                    "channelId": channel_id,
+                    "title": title,
+                    "description": " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 25))),
+                    "thumbnails": self.thumbnails(channel_id),
+                    "channelTitle": f"Channel {n}",
+                    "liveBroadcastContent": "none",
+                    "publishTime": published,
+                },
+            })
+
+        response = {
+            "kind": "youtube#searchListResponse",
+            "etag": self.etag("search", query, search_type, page),
+            "regionCode": "US",
+            "pageInfo": {"totalResults": self.config.total_results, "resultsPerPage": max_results},
+            "items": items,
+        }
+        if (page + 1) * max_results < self.config.total_results:
+            response["nextPageToken"] = f"PAGE{page + 1}"
+        if page:
+            response["prevPageToken"] = f"PAGE{page - 1}"
+        return response
+
+    def channel(self, channel_id, parts):
+        rng = self.seeded("channel", channel_id)
+        if rng.random() < self.config.missing_rate:
+            return None     # Deleted/terminated, the API just leaves it out
+        if self.channel_number(channel_id) is None:
+            return self.viewer_channel(channel_id, parts)
+
+        name = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+        tags = [ rng.choice(WORDS) for _ in range(rng.randint(0, 12)) ] + [ f'"{rng.choice(WORDS)} {rng.choice(WORDS)}"' for _ in range(rng.randint(0, 4)) ]
+        description = " ".join(rng.choice(WORDS) for _ in range(rng.randint(10, 120)))
+        if rng.random() < 0.3:
+            user = name.lower().replace(" ", "")
+            description += f"\n\nBusiness inquiries: {user}@{rng.choice(EMAIL_DOMAINS)}" if rng.random() < 0.7 else f"\n\nContact: {user} AT {rng.choice(EMAIL_DOMAINS)}"
+        subscribers = int(rng.paretovariate(0.8) * 100)
+        country = rng.choice(COUNTRIES)
+        for day in range(1, self.day + 1):
+            # (own generator too, so the rest of the channel stays the same from day to day)
+            if self.seeded("change", channel_id, day).random() < self.config.change_rate:
+                subscribers += 1 + subscribers // 100
+
+        snippet = {
+            "title": name,
+            "description": description,
+            "publishedAt": f"20{rng.randint(6, 23):02d}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T00:00:00Z",
+            "thumbnails": self.thumbnails(channel_id),
+            "localized": {"title": name, "description": description},
+        }
+        if rng.random() < 0.6:
+            snippet["customUrl"] = "@" + name.lower().replace(" ", "")
+        if rng.random() < 0.4:
+            snippet["defaultLanguage"] = "en"
+        if country and rng.random() < 0.7:
+            snippet["country"] = country
+
+        branding_channel = {"title": name, "description": description}
+        if tags:
+            branding_channel["keywords"] = " ".join(tags)
+        if country and "country" not in snippet:
+            branding_channel["country"] = country
+        featured_rng = self.seeded("featured", channel_id)     # (own generator, so the rest of the channel stays the same)
+        if featured_rng.random() < 0.3:
+            branding_channel["featuredChannelsUrls"] = [ self.related_channel(featured_rng) for _ in range(featured_rng.randint(1, 6)) ]
+
+        statistics = {
+            "viewCount": str(subscribers * rng.randint(10, 400)),
+            "subscriberCount": str(subscribers),
+            "hiddenSubscriberCount": False,
+            "videoCount": str(rng.randint(1, 3000)),
+        }
+        status = {"privacyStatus": "public", "isLinked": True, "longUploadsStatus": "longUploadsUnspecified"}
+        if rng.random() < 0.9:
+            status["madeForKids"] = rng.random() < 0.05
+
+        all_parts = {
+            "snippet": snippet,
+            "contentDetails": {"relatedPlaylists": {"likes": "", "uploads": "UU" + channel_id[2:]}},
+            "statistics": statistics,
+            "brandingSettings": {"channel": branding_channel, "image": {"bannerExternalUrl": f"https://yt3.ggpht.com/{channel_id}-banner"}},
+            "status": status,
+        }
+        item = {"kind": "youtube#channel", "etag": self.etag("channel", channel_id, subscribers, *sorted(parts)), "id": channel_id}
+        item.update({ part: value for (part, value) in all_parts.items() if part in parts })
+        return item
+
+    def viewer_channel(self, channel_id, parts):
+        # Someone who only watches (and comments): a channel with no videos, keywords or subscribers to speak of
+        rng = self.seeded("viewer", channel_id)
+        name = f"user{rng.randrange(10**6)}"
+        all_parts = {
+            "snippet": {"title": name, "description": "", "publishedAt": f"20{rng.randint(6, 23):02d}-01-01T00:00:00Z",
+                        "thumbnails": self.thumbnails(channel_id), "localized": {"title": name, "description": ""}},
+            "contentDetails": {"relatedPlaylists": {"likes": "", "uploads": "UU" + channel_id[2:]}},
+            "statistics": {"viewCount": "0", "subscriberCount": str(rng.randint(0, 5)), "hiddenSubscriberCount": False, "videoCount": "0"},
+            "brandingSettings": {"channel": {"title": name}},
+            "status": {"privacyStatus": "public", "isLinked": True},
+        }
+        item = {"kind": "youtube#channel", "etag": self.etag("viewer", channel_id, *sorted(parts)), "id": channel_id}
+        item.update({ part: value for (part, value) in all_parts.items() if part in parts })
+        return item
+
+    def channel_sections(self, params):
+        # Shelves on the channel page, some of them of other channels
+        channel_id = params.get('channelId', [''])[0]
+        rng = self.seeded("sections", channel_id)
+        items = []
+        for i in range(rng.randint(0, 4) if self.channel_number(channel_id) is not None else 0):
+            section = {"kind": "youtube#channelSection", "etag": self.etag("section", channel_id, i), "id": f"{channel_id}.{i}",
+                       "snippet": {"channelId": channel_id, "position": i}}
+            if rng.random() < 0.4:
+                section["snippet"]["type"] = "multipleChannels"
+                section["contentDetails"] = {"channels": [ self.related_channel(rng) for _ in range(rng.randint(2, 10)) ]}
+            else:
+                section["snippet"]["type"] = "singlePlaylist"
+                section["contentDetails"] = {"playlists": [f"PL{channel_id[2:]}x{i}"]}
+            items.append(section)
+        return {"kind": "youtube#channelSectionListResponse", "etag": self.etag("sections", channel_id), "items": items}
+
+    def playlists(self, params):
+        channel_id = params.get('channelId', [''])[0]
+        max_results = min(int(params.get('maxResults', ['5'])[0]), MAX_RESULTS)
+        rng = self.seeded("playlists", channel_id)
+        count = rng.randint(0, 8) if self.channel_number(channel_id) is not None else 0
+        items = [ {"kind": "youtube#playlist", "etag": self.etag("playlist", channel_id, i), "id": f"PL{channel_id[2:]}x{i}",
+                   "snippet": {"channelId": channel_id, "title": " ".join(rng.choice(WORDS) for _ in range(3)).title()}}
+                  for i in range(min(count, max_results)) ]
+        return {"kind": "youtube#playlistListResponse", "etag": self.etag("playlists", channel_id),
+                "pageInfo": {"totalResults": count, "resultsPerPage": max_results}, "items": items}
+
+    def playlist_items(self, params):
+        # Mostly the channel's own videos, but playlists often have other creators' videos in them too
+        playlist_id = params.get('playlistId', [''])[0]
+        channel_id = "UC" + playlist_id[2:].split('x')[0]
+        max_results = min(int(params.get('maxResults', ['5'])[0]), MAX_RESULTS)
+        rng = self.seeded("playlistItems", playlist_id)
+        mixed = rng.random() < 0.4
+        items = []
+        for i in range(min(rng.randint(1, 60), max_results)):
+            owner = self.related_channel(rng) if mixed and rng.random() < 0.5 else channel_id
+            items.append({"kind": "youtube#playlistItem", "etag": self.etag("playlistItem", playlist_id, i), "id": f"{playlist_id}.{i}",
+                          "snippet": {"playlistId": playlist_id, "position": i, "title": " ".join(rng.choice(WORDS) for _ in range(4)).title(),
+                                      "channelId": channel_id, "videoOwnerChannelId": owner,
+                                      "resourceId": {"kind": "youtube#video", "videoId": hashlib.md5(f"{playlist_id}{i}".encode()).hexdigest()[:11]}}})
+        return {"kind": "youtube#playlistItemListResponse", "etag": self.etag("playlistItems", playlist_id), "items": items}
+
+    def comment_threads(self, params):
+        # Comments on the channel's videos, mostly from viewers
+        channel_id = params.get('allThreadsRelatedToChannelId', [''])[0]
+        max_results = min(int(params.get('maxResults', ['20'])[0]), MAX_COMMENT_RESULTS)
+        rng = self.seeded("commentThreads", channel_id)
+        items = []
+        for i in range(min(rng.randint(0, 150), max_results) if self.channel_number(channel_id) is not None else 0):
+            if rng.random() < COMMENTER_VIEWER_RATE:
+                author = self.channel_id(self.config.universe + rng.randrange(10 * self.config.universe))
+            else:
+                author = self.related_channel(rng)
+            comment = {"kind": "youtube#comment", "id": f"Ug{i}", "snippet": {
+                "channelId": channel_id, "textDisplay": " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 20))),
+                "authorDisplayName": f"@user{i}", "authorChannelId": {"value": author}, "likeCount": rng.randint(0, 100)}}
+            items.append({"kind": "youtube#commentThread", "etag": self.etag("comment", channel_id, i), "id": f"Ug{i}",
+                          "snippet": {"channelId": channel_id, "topLevelComment": comment, "totalReplyCount": 0}})
+        return {"kind": "youtube#commentThreadListResponse", "etag": self.etag("commentThreads", channel_id),
+                "pageInfo": {"totalResults": len(items), "resultsPerPage": max_results}, "items": items}
+
+    def channels(self, params):
+        parts = set(params.get('part', [''])[0].split(','))
+        ids = [ x for x in params.get('id', [''])[0].split(',') if x ][:MAX_RESULTS]
+        items = [ item for item in (self.channel(channel_id, parts) for channel_id in ids) if item ]
+        response = {
+            "kind": "youtube#channelListResponse",
+            "etag": self.etag("channels", *( item["etag"] for item in items )),  # Changes when any of them does
+            "pageInfo": {"totalResults": len(items), "resultsPerPage": len(items)},
+        }
+        if items:
+            response["items"] = items   # Like the real API, no "items" at all if nothing came back
+        return response
+
+    def handle(self, path, query_string, if_none_match=None):
+        # Returns (status, JSON body) for a request, after the simulated latency.  (304, None) if the response's etag
+        # is if_none_match, which still costs the same credits.
+        params = parse_qs(query_string, keep_blank_values=True)
+        endpoint = path[len(API_PATH):].strip('/') if path.startswith(API_PATH) else None
+
+        with self.lock:
+            latency = self.rng.expovariate(1000.0 / self.config.latency_ms) if self.config.latency_ms else 0
+            roll = self.rng.random()
+        if latency:
+            time.sleep(latency)
+
+        if endpoint not in ENDPOINTS:
+            return 404, error_body(404, "notFound", "Not Found")
+        if not params.get('key', [''])[0]:
+            return 403, error_body(403, "forbidden", "The request is missing a valid API key.")
+        if roll < self.config.error_rate:
+            return 503, error_body(503, "backendError", "Backend Error")
+        if roll < self.config.error_rate + self.config.quota_error_rate or not self.charge(SEARCH_COST if endpoint == "search" else CHANNEL_COST if endpoint == "channels" else LIST_COST):
+            return 403, error_body(403, "quotaExceeded", "The request cannot be completed because you have exceeded your quota.", "youtube.quota")
+
+        response = {"search": self.search, "channels": self.channels, "channelSections": self.channel_sections, "playlists": self.playlists,
+                    "playlistItems": self.playlist_items, "commentThreads": self.comment_threads}[endpoint](params)
+        fields = params.get('fields', [''])[0]
+        if fields:
+            # Like the real API, the etag is of what comes back, so a partial response has its own
+            response["etag"] = self.etag(response["etag"], fields)
+        if if_none_match is not None and response["etag"] == if_none_match:
+            with self.lock:
+                self.not_modified += 1
+            return 304, None
+        if fields:
+            response = apply_fields(response, parse_fields(fields))
+        return 200, response
+
+    def sent(self, num_bytes):
+        with self.lock:
+            self.bytes_sent += num_bytes
+
+
+def parse_fields(spec):
+    # Parse a partial response fields= mask into a tree of the fields to keep, e.g.
+    # "kind,items(id,snippet(title,thumbnails/default/url))" -> {"kind": {}, "items": {"id": {}, "snippet": {"title": {}, "thumbnails": {"default": {"url": {}}}}}}
+    # An empty subtree means keep all of it.
+    def parse(i, tree):
+        # Parses a comma separated list into tree, starting at spec[i].  Returns where it ended (after the closing bracket)
+        while i < len(spec):
+            j = i
+            while j < len(spec) and spec[j] not in ",()":
+                j += 1
+            node = tree
+            for name in spec[i:j].split('/'):
+                node = node.setdefault(name, {})
+            if j < len(spec) and spec[j] == '(':
+                j = parse(j + 1, node)
+            if j < len(spec) and spec[j] == ')':
+                return j + 1
+            i = j + 1
+        return i
+
+    tree = {}
+    parse(0, tree)
+    return tree
+
+
+def apply_fields(value, tree):
+    # Cut a response down to the fields in tree (see parse_fields()), the same way the real API does
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [ apply_fields(x, tree) for x in value ]
+    if isinstance(value, dict):
+        return { key: apply_fields(x, tree[key]) for (key, x) in value.items() if key in tree }
+    return value
+
+
+def error_body(code, reason, message, domain="global"):
+    return {"error": {"code": code, "message": message, "errors": [{"message": message, "domain": domain, "reason": reason}]}}
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"       # keep-alive, like the real API
+    api = None                          # FakeYouTube, set by make_server()
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        status, body = self.api.handle(parts.path, parts.query, self.headers.get("If-None-Match"))
+        data = json.dumps(body).encode('utf-8') if body is not None else b""
+        self.api.sent(len(data))
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass    # Way too chatty
+
+
+def make_server(config, host="127.0.0.1", port=DEFAULT_PORT):
+    # Returns (server, FakeYouTube).  port=0 picks a free port, see server.server_address.
+    api = FakeYouTube(config)
+    handler = type("BoundFakeHandler", (FakeHandler,), {"api": api})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server, api
+
+
+def start_in_thread(config, host="127.0.0.1", port=0):
+    # Starts a server in the background, returns (server, FakeYouTube, base URL to give the crawler)
+    server, api = make_server(config, host, port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address[:2]
+    return server, api, f"http://{host}:{port}{API_PATH}"
+
+
+#####################################
+# Main
+#####################################
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake YouTube Data API (search, channels and the listings discovery expansion uses) for testing the crawler.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--universe", type=int, default=100000, help="Number of distinct channels")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="Mean response latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of 503 responses")
+    parser.add_argument("--quota-error-rate", type=float, default=0.0, help="Fraction of 403 quotaExceeded responses")
+    parser.add_argument("--missing-rate", type=float, default=0.02, help="Fraction of deleted channels")
+    parser.add_argument("--daily-quota", type=int, help="403 quotaExceeded everything after this many credits")
+    parser.add_argument("--change-rate", type=float, default=0.1, help="Fraction of channels whose statistics change each day")
+    parser.add_argument("--days", type=int, default=0, help="Days to start at (each one changes some channels' statistics)")
+    args = parser.parse_args()
+
+    config = FakeConfig(seed=args.seed, universe=args.universe, latency_ms=args.latency_ms, error_rate=args.error_rate,
+                        quota_error_rate=args.quota_error_rate, missing_rate=args.missing_rate, daily_quota=args.daily_quota,
+                        change_rate=args.change_rate)
+    server, api = make_server(config, args.host, args.port)
+    api.advance(args.days)
+    print(f"Fake YouTube API listening on http://{args.host}:{server.server_address[1]}{API_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(f"\nServed {api.requests} requests ({api.not_modified} not modified), {api.credits_used} credits, {api.bytes_sent / 1024**2:.1f} MB.")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,25 +3,34 @@
 
 # NOTE: To start a clean crawl, delete database file!  (But don't really ever need to do this, just add to what's there)
 
-import io
-import re
-import pickle
 import time
-import requests
-import json
 import csv
 import sys
+import argparse
+import importlib
+import os
+import queue
+import socket
+import subprocess
+import threading
+import traceback
 
 from time import sleep
-from urllib.parse import quote as urlquote
-from datetime import datetime
+from urllib.parse import quote as urlquote, unquote as urlunquote
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 
 # DB stuff
-from sqlalchemy import Column, Integer, String, Boolean, BigInteger
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy import Column, Integer, String, Boolean, BigInteger, Float, ForeignKey, Index, UniqueConstraint
+from sqlalchemy import create_engine, event, update, insert, select, bindparam, inspect, text, or_
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import declarative_base, sessionmaker
 
-from twilio.rest import Client
+from yt_query import create_search_index, DB_URL
+from yt_cache import ResponseCache, CACHE_DIR
+from yt_extract import parse_keywords, find_emails, channel_country
+from yt_export import create_change_tracking
+from yt_metrics import CrawlMetrics, endpoint_name, per_key_path, METRICS_FILE, EVENTS_FILE, COMMIT_BUCKETS
 
 #####################################
 # CONSTANTS
@@ -67,75 +76,1610 @@ SEARCH_MODIFIERS = {
 API_BASE_URL = "https://www.googleapis.com/youtube/v3/"
 API_KEY = 'xxx_GOOGLE_YOUTUBE_API_KEY_xxx'
 
+# Each Google Cloud project's key has its own daily quota.  --key picks which one this run uses, and --workers N
+# runs a crawl worker process for each of the first N of them, all working off the same search queue (SearchTask).
+DEFAULT_KEY = "default"
+API_KEYS = {
+    DEFAULT_KEY: API_KEY,
+    # "project-2": 'xxx_SECOND_PROJECT_API_KEY_xxx',
+}
+
 # QUOTA
-# 10,000/day limit
+# 10,000/day limit, resets at midnight Pacific time
 # 1/s limit
 # 86,400 seconds / day
 # So average rate would be 0.115 hits/s  (8.64 seconds/hit)
-# TARGET_RATE = 0.115     # credits/s average (10,000credits / 86,400seconds)
-TARGET_RATE = 0.112     # When this runs a real long time, it seems to go over, so fudge it down a bit, probably floating point precision error
-SEARCH_SLEEP = 2.1
-CHANNEL_SLEEP = 2.1     # These are just guesses designed to slow it down to reasonable rates.  Function later forces it to average rate.
+# The QuotaScheduler paces calls so the remaining budget gets spread out over the rest of the quota day.
+DAILY_QUOTA = 10000
+QUOTA_TIMEZONE = ZoneInfo("America/Los_Angeles")   # The API's quota day runs midnight to midnight Pacific time
+QUOTA_BURST = 250       # Token bucket size in credits.  Has to fit the most expensive call (a search)
+MIN_REQUEST_INTERVAL = 1.0  # seconds between calls, to stay under the 1/s limit
+
+# The daily quota gets split between discovering new channels (the normal crawl) and refreshing the statistics of
+# the channels we already have (--refresh).  Each gets its own share, tracked separately in the QuotaLedger.
+REFRESH_SHARE = 0.2
+# Whatever's left of the refresh's share this close to the quota reset would just go unused (e.g. when the refresh
+# isn't run at all), so discovery gets to spend it (see QuotaScheduler.lender)
+REFRESH_LEND_WINDOW = timedelta(hours=2)
+QUOTA_POOL_DISCOVERY = "discovery"
+QUOTA_POOL_REFRESH = "refresh"
+
+# Quota cost of each type of call
+SEARCH_COST = 100
+CHANNEL_COST = 1        # Same cost no matter how many ids are in the call
+LIST_COST = 1           # channelSections, playlists, playlistItems and commentThreads, see expand_channel()
+
+CHANNEL_BATCH_SIZE = 50 # channels.list takes up to 50 comma-separated ids per call, for the same 1 credit
+
+# Exactly what gets read out of each item of each call's response, as (name, path in the item, default if it isn't
+# there, conversion).  The part= and fields= parameters of the calls are generated from these (see
+# partial_response()), so the API only sends back these values, and parsing reads them straight into a tuple in
+# this order (see extract_fields()).
+SEARCH_ITEM_FIELDS = (
+    ("kind",                ("kind",),                                  None, None),
+    ("channel_id",          ("snippet", "channelId"),                   None, None),   # Even if the search result was a video, it's the channel for that video
+)
+SEARCH_RESPONSE_FIELDS = ("kind", "etag", "nextPageToken")
+
+CHANNEL_ITEM_FIELDS = (
+    ("channel_id",          ("id",),                                    None, None),
+    ("etag",                ("etag",),                                  None, None),   # Changes when anything about the channel does
+    ("title",               ("snippet", "title"),                       '', None),
+    ("description",         ("snippet", "description"),                 '', None),
+    ("thumb_default",       ("snippet", "thumbnails", "default", "url"), '', None),
+    ("thumb_med",           ("snippet", "thumbnails", "medium", "url"), '', None),
+    ("thumb_high",          ("snippet", "thumbnails", "high", "url"),   '', None),
+    ("published_at",        ("snippet", "publishedAt"),                 '', None),
+    ("custom_url",          ("snippet", "customUrl"),                   '', None),
+    ("default_language",    ("snippet", "defaultLanguage"),             '', None),
+    ("snippet_country",     ("snippet", "country"),                     '', None),
+    ("branding_country",    ("brandingSettings", "channel", "country"), '', None),  # The country can be in either place
+    ("branding_keywords",   ("brandingSettings", "channel", "keywords"), '', None),
+    ("featured_channels",   ("brandingSettings", "channel", "featuredChannelsUrls"), [], None),   # channel ids, for expand
+    ("view_count",          ("statistics", "viewCount"),                0, int),    # YT API returns these as strings
+    ("subscriber_count",    ("statistics", "subscriberCount"),          0, int),    # Not there if the channel hides it
+    ("video_count",         ("statistics", "videoCount"),               0, int),
+    ("made_for_kids",       ("status", "madeForKids"),                  False, None),
+)
+CHANNEL_RESPONSE_FIELDS = ("kind", "etag")
+
+# Just the numbers, for the stats refresh (--refresh)
+STATS_ITEM_FIELDS = (
+    ("channel_id",          ("id",),                                    None, None),
+    ("etag",                ("etag",),                                  None, None),   # Of just this part, see Channel.stats_etag
+    ("view_count",          ("statistics", "viewCount"),                0, int),
+    ("subscriber_count",    ("statistics", "subscriberCount"),          0, int),
+    ("video_count",         ("statistics", "videoCount"),               0, int),
+)
+
+# The listings discovery expansion reads other channels out of (see expand_channel())
+SECTION_ITEM_FIELDS = (
+    ("channels",            ("contentDetails", "channels"),             [], None),     # Only in "multipleChannels" sections
+)
+PLAYLIST_ITEM_FIELDS = (
+    ("playlist_id",         ("id",),                                    None, None),
+)
+PLAYLIST_VIDEO_FIELDS = (
+    ("owner_channel_id",    ("snippet", "videoOwnerChannelId"),         None, None),
+)
+COMMENT_ITEM_FIELDS = (
+    ("author_channel_id",   ("snippet", "topLevelComment", "snippet", "authorChannelId", "value"), None, None),
+)
+LIST_RESPONSE_FIELDS = ("kind", "etag")
+
+# The Channel columns parse_channel() fills in, in the order of the row tuples it returns
+CHANNEL_COLUMNS = ("channel_id", "title", "description", "thumb_default", "thumb_med", "thumb_high", "published_at",
+                   "custom_url", "default_language", "country", "view_count", "subscriber_count", "video_count",
+                   "made_for_kids", "potential_contact_emails", "stats_updated_at", "branding_keywords",
+                   "snippet_country", "branding_country", "etag")
+
+# Search work queue (SearchTask).  Every search we plan to do, and every further page of results, is a task.
+# The next one to send is whichever is expected to find the most new channels per 100 credits, going by how the
+# searches so far did: a first page is expected to do as well as the other searches for the same keyword did (or as
+# the average first page, for a keyword we haven't tried yet), and a later page as well as the page before it did,
+# times how well later pages have held up so far.  Both estimates start out from these priors, weighted as if
+# they'd been seen over this many searches / channels.
+SEARCH_PRIOR_NEW = 25           # New channels expected from a first page, before there's anything to go by
+SEARCH_PRIOR_WEIGHT = 2         # searches
+PAGE_DECAY_PRIOR = 0.7          # Expected new channels on the next page, as a fraction of the page before
+PAGE_DECAY_PRIOR_WEIGHT = 50    # channels
+MAX_SEARCH_PAGES = 10           # Don't follow nextPageToken past this many pages (50 results each)
+SEARCH_LEASE = timedelta(minutes=5)     # A task handed out by a crawl that died goes back in the queue after this
+LEASE_RENEW_SECONDS = 60                # and a running crawl renews its leases this often, so they never run out on it
 
-# Twilio to text me on failures
-# the following line needs your Twilio Account SID and Auth Token
-twilio_client = Client("xxx_Twilio_Account_SID_xxx", "xxx_Twilio_Auth_Token_xxx")
-to_num = "+1xxx_xxx_xxxx",    # Your phone
-from_num= "+1xxx_xxx_xxxx"    # Twilio account phone
+# SearchTask.status
+TASK_PENDING = "pending"
+TASK_LEASED = "leased"
+TASK_DONE = "done"
+
+# Where a channel's keyword tag came from, see ChannelKeyword
+KEYWORD_SOURCE_CREATOR = "creator"  # the channel's own tags, from brandingSettings
+KEYWORD_SOURCE_SEARCH = "search"    # the keyword from our search that found the channel
+
+# Stats refresh (--refresh).  Channels are refreshed most-overdue first: how long since their statistics were last
+# read, scaled up for channels that are growing fast (by 1 + REFRESH_GROWTH_WEIGHT * daily subscriber growth as a
+# fraction of their subscribers, so a channel growing 1%/day counts as twice as overdue).
+REFRESH_MIN_AGE = timedelta(hours=20)   # Don't re-read a channel more often than this
+REFRESH_GROWTH_WEIGHT = 100
+REFRESH_CHUNK = 1000                    # Channels picked per query (then looked up CHANNEL_BATCH_SIZE at a time)
+
+# Discovery expansion (expand): finding new channels through the ones we already have, with 1-credit listings
+# instead of 100-credit searches.  Every channel that a channel of ours mentions becomes a ChannelCandidate, scored
+# before it's looked up: for each mention, how many of our keywords (the words of the keywords file's keywords) the
+# mentioning channel's keywords have, times how much that kind of mention counts for.  The best candidates get
+# looked up CHANNEL_BATCH_SIZE per credit, and only get saved if their own keywords have some of ours too.
+EXPAND_SOURCES = {
+    "featured": 1.0,        # brandingSettings featured channels, which come with every channel lookup for free
+    "sections": 1.0,        # channel page sections of other channels (channelSections, 1 credit)
+    "playlists": 0.5,       # other creators' videos in the channel's playlists (playlists + playlistItems, 1 credit each)
+    "comments": 0.25,       # commenters on the channel's videos (commentThreads, 1 credit), mostly just viewers
+}
+EXPAND_MIN_SCORE = 1.0      # Don't look up candidates that score less than this
+EXPAND_PLAYLISTS = 2        # Playlists gone through per channel
+EXPAND_COMMENTS = 100       # Comment threads per channel (the most one call returns)
+EXPAND_CHUNK = 50           # Channels picked to expand per query
+
+# ChannelCandidate.status
+CANDIDATE_PENDING = "pending"
+CANDIDATE_SAVED = "saved"           # looked up and saved as a Channel
+CANDIDATE_REJECTED = "rejected"     # looked up, but had none of our keywords (or was deleted)
+
+# Write-behind DB writer.  Rows get committed together once either of these is hit (checked after each search
+# or channel batch is handled), instead of one commit (and fsync) per row.
+WRITE_BATCH_ROWS = 2000     # Channels, searches and channel keyword tags all count as rows
+WRITE_BATCH_SECONDS = 30
+
+# Concurrent crawl mode (--concurrent), only worth it with a raised quota or when latency is the bottleneck
+SEARCH_WORKERS = 2      # threads sending searches
+CHANNEL_WORKERS = 2     # threads looking up batches of channels
+
+# Twilio to text me on failures (see text_me_then_quit())
+# needs your Twilio Account SID and Auth Token
+TWILIO_ACCOUNT_SID = "xxx_Twilio_Account_SID_xxx"
+TWILIO_AUTH_TOKEN = "xxx_Twilio_Auth_Token_xxx"
+TO_NUM = "+1xxx_xxx_xxxx"       # Your phone
+FROM_NUM = "+1xxx_xxx_xxxx"     # Twilio account phone
+NOTIFIER = "twilio"             # How to send alerts by default, see NOTIFIERS
 
 #####################################
 # Helper Functions
 #####################################
 
+class CrawlAborted(Exception):
+    # Raised by text_me_then_quit() to stop whatever is running, main() turns it into exit code 1
+    pass
+
+
+def twilio_notifier(msg):
+    # Twilio only gets imported (and its client made) when there's actually something to send
+    from twilio.rest import Client
+    Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN).messages.create(to=TO_NUM, from_=FROM_NUM, body=msg)
+
+
+def print_notifier(msg):
+    print(f"ALERT: {msg}")
+
+
+def no_notifier(msg):
+    pass
+
+
+# --notifier choices.  Any function that takes the message will do, e.g. yt_influencers.notifier = post_to_slack
+NOTIFIERS = {"twilio": twilio_notifier, "print": print_notifier, "none": no_notifier}
+notifier = NOTIFIERS[NOTIFIER]
+
+
 # Give it some default text because for most purposes, I just need to know it quit.
 def text_me_then_quit(msg="YouTube scraping script aborted!"):
-    twilio_client.messages.create(to=to_num, 
-                       from_=from_num, 
-                       body=msg)
-    sys.exit()
-
-
-def parse_keywords(text, search_keyword):
-    # Split the keywords into comma-separated list, but need to keep the words between " " tokenized
-    # This is more difficult than I would have imagined, and ended up writing a function for it.
-    out = ""
-    in_quote = False
-    for c in text:
-        # Iterate character by character
-        if c == '"':
-            # Toggle the state of if we're inside a double quote or not
-            if not in_quote:
-                in_quote = True
+    # Not being able to send the alert shouldn't hide why we're quitting
+    try:
+        notifier(msg)
+    except Exception as e:
+        print(f"Exception {e} when trying to send alert: {msg}")
+    raise CrawlAborted(msg)
+
+
+def api_get(url, expected_kind, cost, etag=None):
+    # Send request and wait for response, up to 3 times.  Returns the parsed JSON response.
+    # Every attempt counts against the quota, so each one waits on the scheduler first.
+    # With the etag of an earlier response for url, only asks for it if it changed (If-None-Match), and returns None
+    # if it didn't (304 Not Modified, no body to download or parse).
+    import requests     # Already imported by open_http_session(), see there
+    endpoint = endpoint_name(url)
+    headers = {'If-None-Match': etag} if etag else None
+    for times in range(0, 3):
+        if times > 0:
+            metrics.inc("api_retries_total", endpoint=endpoint)
+        quota.acquire(cost)
+        started = time.monotonic()
+        try:
+            response = http.get(url=url, headers=headers)     # pooled keep-alive connection, see open_http_session()
+        except requests.exceptions.ConnectionError as e:
+            record_request(endpoint, "error", time.monotonic() - started, times, cost)
+            print(f"Connection error: {e}")
+            print("Can't connect, are you online?")
+            if times >= 2:
+                print("Fatal Error, too many retries.")
+                text_me_then_quit()
             else:
-                in_quote = False
-        elif c == ' ':
-            # If a space, it depends on if we're in the middle of a quoted keyword or not
-            if in_quote:
-                out += ' '  # copy to output if inside quotes
+                backoff(10**(times+1))  # Sleeps 10 seconds, then 100 seconds (on last failure just aborts)
+                continue
+
+        if response.status_code == 304:
+            record_request(endpoint, 304, time.monotonic() - started, times, cost)
+            return None
+
+        json_response = response.json()
+        record_request(endpoint, response.status_code, time.monotonic() - started, times, cost)
+
+        # Sanity check everything
+        if response.status_code == 200:
+            break
+        else:
+            # If HTTP doesn't return 200, try again after waiting
+            print(f"Error, invalid status code.  Should be 200, got {response.status_code}")
+            if times >= 2:
+                print("Fatal Error, too many retries.")
+                text_me_then_quit()
             else:
-                out += ','  # else make comma-separated
+                backoff(10**(times+1))  # Sleeps 10 seconds, then 100 seconds (on last failure just aborts)
+
+    if json_response['kind'] != expected_kind:
+        print(f"Fatal Error, should be kind={expected_kind}, but got kind={json_response['kind']}")
+        text_me_then_quit()
+
+    return json_response
+
+
+def api_get_revalidated(url, expected_kind, cost):
+    # api_get() for a URL the response cache may have an older response for: asks for it only if it changed since
+    # (by the cached response's etag), and if it didn't, uses the cached one again.  Either way the response gets
+    # (re)cached.  Returns (json_response, whether it changed).
+    cached = cache.peek(url)
+    json_response = api_get(url, expected_kind, cost, etag=cached.get('etag') if cached else None)
+    if json_response is None:
+        cache.put(url, cached)      # Fresh again
+        return cached, False
+    cache.put(url, json_response)
+    return json_response, True
+
+
+def record_request(endpoint, status, seconds, attempt, cost):
+    # Latency and status of one API call (see yt_metrics.py)
+    metrics.observe("api_request_seconds", seconds, endpoint=endpoint)
+    metrics.inc("api_responses_total", endpoint=endpoint, status=status)
+    metrics.event("request", endpoint=endpoint, status=status, seconds=round(seconds, 4), attempt=attempt + 1, cost=cost)
+    metrics.maybe_write()
+
+
+def timed_sleep(seconds, reason):
+    # sleep(), counted in the metrics as time spent not working
+    metrics.inc("sleep_seconds_total", seconds, reason=reason)
+    metrics.event("sleep", reason=reason, seconds=round(seconds, 3))
+    sleep(seconds)
+
+
+def backoff(seconds):
+    timed_sleep(seconds, "retry backoff")
+
+
+def print_time_spent():
+    # Sleeping vs working (with --concurrent, the threads' times add up to more than the run's)
+    metrics.set("cache_hits_total", cache.hits)
+    metrics.set("cache_misses_total", cache.misses)
+    run_seconds = time.monotonic() - metrics.started
+    print(f"Ran {run_seconds:.1f}s: slept {metrics.total('sleep_seconds_total'):.1f}s, waited {metrics.total('api_request_seconds'):.1f}s on "
+          f"{metrics.total('api_responses_total'):.0f} API calls ({metrics.total('credits_spent_total'):.0f} credits), "
+          f"committed for {metrics.total('db_commit_seconds'):.1f}s.")
+
+
+def open_http_session(pool_size):
+    # One pooled keep-alive HTTP client for all API calls, instead of a new TLS connection for every request.
+    # requests only gets imported here (and in api_get()), so it's only loaded by runs that actually send requests.
+    import requests
+    from requests.adapters import HTTPAdapter
+    http = requests.Session()
+    http.headers.update({'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'})
+    http_adapter = HTTPAdapter(pool_maxsize=max(1, pool_size))
+    http.mount('https://', http_adapter)
+    http.mount('http://', http_adapter)
+    return http
+
+
+def partial_response(item_fields, response_fields):
+    # The part= and fields= URL parameters that ask for just these fields (see CHANNEL_ITEM_FIELDS), e.g.
+    # part=snippet,statistics&fields=kind,items(id,snippet(title,thumbnails/default/url),statistics(viewCount))
+    parts = []
+    singles = []
+    groups = {}
+    for name, path, default, convert in item_fields:
+        if len(path) == 1:
+            singles.append(path[0])
         else:
-            # Copy to output
-            out += c.lower()
-    
-    # Lastly, in case there are duplicate tags, remove them by creating a list, uniquifying, then converting back to string
-    out_list = [ x for x in out.split(',') ]    # Make a list
-    out_list.append(search_keyword)             # Add in the keyword from our search
-    out_list = list(set(out_list))              # Uniquify duplicates
-    if '' in out_list:
-        out_list.remove('')
-    out = ','.join(out_list)                    # Turn back to comma separated string
+            if path[0] not in groups:
+                parts.append(path[0])
+            groups.setdefault(path[0], []).append("/".join(path[1:]))
+
+    items = singles + [ f"{part}({','.join(fields)})" for (part, fields) in groups.items() ]
+    fields = ",".join(response_fields + (f"items({','.join(items)})",))
+    return f"part={urlquote(','.join(parts or ['id']))}&fields={urlquote(fields)}"
+
+
+def extract_fields(item, item_fields):
+    # Read the fields out of one response item into a tuple, in item_fields order
+    values = []
+    for name, path, default, convert in item_fields:
+        value = item
+        try:
+            for key in path:
+                value = value[key]
+        except KeyError:
+            values.append(default)
+            continue
+        values.append(convert(value) if convert else value)
+    return tuple(values)
+
+
+def parse_channel(item):
+    # Turn one youtube#channel item from a channels.list response into a new Channel row.
+    # Returns (tuple of the CHANNEL_COLUMNS, list of the creator-tagged keywords, list of its featured channel ids)
+    (channel_id, etag, title, description, thumb_default, thumb_med, thumb_high, published_at, custom_url, default_language,
+     snippet_country, branding_country, branding_keywords, featured_channels, view_count, subscriber_count, video_count,
+     made_for_kids) = extract_fields(item, CHANNEL_ITEM_FIELDS)
+
+    # The derived fields (see yt_extract.py).  The raw values they come from get saved too, so they can be
+    # re-derived later without re-crawling (see yt_reprocess.py)
+    country = channel_country(snippet_country, branding_country)
+
+    # Build keywords to tag this channel (our own search keywords get tagged on separately, see ChannelKeyword)
+    # branding_keywords is a space separated string on YouTube.  e.g. '"Jamie obrien" surfing "who is job" "weird waves" "river surfing" surf "the wedge" "jamie o\'brien" "how to surf" pipeline hawaii'
+    final_keywords = parse_keywords(branding_keywords)                          # Parse the creator-tagged keywords
+
+    # Extract potential contact emails from the channel description (no way to get through API)
+    potential_contact_emails = ','.join(find_emails(description))               # Make a comma-separated string
+
+    # New channel row for the DB, in CHANNEL_COLUMNS order
+    new_channel = (channel_id, title, description, thumb_default, thumb_med, thumb_high, published_at, custom_url,
+                   default_language, country, view_count, subscriber_count, video_count, made_for_kids,
+                   potential_contact_emails, utc_timestamp(), branding_keywords, snippet_country, branding_country, etag)
+    return new_channel, [ x for x in final_keywords.split(',') if x ], featured_channels
+
+
+class QuotaScheduler:
+    # Token bucket over the daily API quota, with the credits spent each quota day kept in the QuotaLedger
+    # table so a restarted crawl picks up wherever the budget was left.
+    # The bucket refills at whatever rate spreads the rest of today's budget evenly over the time left until the
+    # quota resets, so falling behind (e.g. after being stopped for a while) gets made up by the end of the day,
+    # and it can never go over.
+    # Shared by all the threads in the concurrent crawl, so calls go through one at a time under a lock, and it
+    # keeps its own DB session for the ledger.
+    # pool is which share of which key's quota this is spending (see quota_pool()), each pool has its own
+    # daily_budget and ledger rows.
+    # lender is another pool's QuotaScheduler whose unspent credits this one can spend once its own budget is used up,
+    # in the last lend_window before the reset.  They get spent through the lender, so they're paced and counted
+    # against the lender's pool, and the two pools together never go over.
+
+    def __init__(self, daily_budget=DAILY_QUOTA, pool=QUOTA_POOL_DISCOVERY, burst=QUOTA_BURST, min_interval=MIN_REQUEST_INTERVAL,
+                 lender=None, lend_window=REFRESH_LEND_WINDOW):
+        self.daily_budget = daily_budget
+        self.pool = pool
+        self.lender = lender
+        self.lend_window = lend_window
+        self.burst = burst
+        self.min_interval = min_interval
+        self.last_request = 0.0     # time.monotonic() of the last call let through
+        self.borrowing = False      # Whether this quota day's budget ran out and it's spending the lender's
+        self.quota_day = None
+        self.lock = threading.Lock()
+        self.db = Session()
+        self.start_day()
+
+    def start_day(self):
+        # (Re)load what's already been spent on the current quota day, and start out with a full bucket
+        now = datetime.now(QUOTA_TIMEZONE)
+        self.quota_day = now.date()
+        self.reset_at = datetime.combine(self.quota_day + timedelta(days=1), datetime.min.time(), tzinfo=QUOTA_TIMEZONE)
+
+        self.spent = self.read_spent()
+        self.tokens = min(self.burst, self.remaining())
+        self.last_refill = now
+
+    def read_spent(self):
+        # What the ledger has for this pool today, including anything another process spent from it
+        ledger = self.db.query(QuotaLedger).filter(QuotaLedger.quota_day == self.quota_day.isoformat(), QuotaLedger.pool == self.pool).first()
+        self.db.close()
+        return ledger.credits_used if ledger else 0
+
+    def remaining(self):
+        return max(0, self.daily_budget - self.spent)
+
+    def refill(self, now):
+        # Refill rate is (credits left today that aren't already in the bucket) / (seconds until the reset)
+        seconds_left = max(1.0, (self.reset_at - now).total_seconds())
+        rate = max(0, self.remaining() - self.tokens) / seconds_left
+        self.tokens = min(self.burst, self.tokens + rate * (now - self.last_refill).total_seconds())
+        self.last_refill = now
+        return rate
+
+    def acquire(self, cost):
+        # Block until `cost` credits can be spent, then record them as spent.
+        with self.lock:
+            self._acquire(cost)
+
+    def try_acquire(self, cost):
+        # Same, but only out of what's left today: returns False instead of waiting for the quota reset.  For lending,
+        # so it goes by the ledger every time round (e.g. a refresh running at the same time spends from it too).
+        with self.lock:
+            return self._acquire(cost, wait_for_reset=False)
+
+    def _acquire(self, cost, wait_for_reset=True):
+        while True:
+            now = datetime.now(QUOTA_TIMEZONE)
+            if now >= self.reset_at:
+                if not wait_for_reset:
+                    return False
+                print(f"Quota day rolled over, spent {self.spent} credits on {self.quota_day.isoformat()}.")
+                self.borrowing = False
+                self.start_day()
+                continue
+            if not wait_for_reset:
+                self.spent = self.read_spent()
+
+            rate = self.refill(now)
+            if cost > self.remaining():
+                if not wait_for_reset:
+                    return False
+                lend_from = self.reset_at - self.lend_window
+                if self.lender is not None and now >= lend_from and self.lender.try_acquire(cost):
+                    # Spent some of the lender's leftovers instead
+                    if not self.borrowing:
+                        print(f"Daily budget used up, borrowing what's left of the {self.lender.pool} credits until the quota reset.")
+                        self.borrowing = True
+                    metrics.inc("credits_borrowed_total", cost, pool=self.pool, lender=self.lender.pool)
+                    return True
+                # Nothing left today, wait for the API's quota reset (or until the lender's leftovers can be borrowed)
+                wait = ((lend_from if self.lender is not None and now < lend_from else self.reset_at) - now).total_seconds() + 1
+                reason = "daily budget used up"
+            elif self.tokens < cost:
+                # Wait exactly as long as it takes the bucket to refill enough
+                wait = (cost - self.tokens) / rate if rate > 0 else (self.reset_at - now).total_seconds() + 1
+                reason = "waiting on quota"
+            else:
+                break
+
+            print("... sleep {0:.0f}s, {1}.  credits_used(today)={2:5d}/{3:d}.  channels_grabbed(this run)={4:7d} ...".format(wait, reason, self.spent, self.daily_budget, channels_grabbed))
+            timed_sleep(min(wait, (self.reset_at - now).total_seconds() + 1), reason)
+
+        # Stay under the 1/s limit too
+        since_last = time.monotonic() - self.last_request
+        if since_last < self.min_interval:
+            timed_sleep(self.min_interval - since_last, "rate limit")
+        self.last_request = time.monotonic()
+
+        self.tokens -= cost
+        self.record(cost)
+        return True
+
+    def record(self, cost):
+        # Add to today's running total in the ledger.  Anything else spending from the same pool (e.g. another crawl
+        # on the same key) adds to the same row, so read the total back to keep up with it too.
+        ledger = QuotaLedger.__table__
+        try:
+            self.db.execute(sqlite_insert(ledger).values(quota_day=self.quota_day.isoformat(), pool=self.pool, credits_used=cost)
+                            .on_conflict_do_update(index_elements=['quota_day', 'pool'], set_={'credits_used': ledger.c.credits_used + cost}))
+            self.spent = self.db.execute(select(ledger.c.credits_used).where(ledger.c.quota_day == self.quota_day.isoformat(), ledger.c.pool == self.pool)).scalar_one()
+            self.db.commit()
+            metrics.inc("credits_spent_total", cost, pool=self.pool)
+            metrics.set("quota_spent_today", self.spent, pool=self.pool)
+            metrics.set("quota_daily_budget", self.daily_budget, pool=self.pool)
+        except Exception as e:
+            print(f"Exception {e} when trying to update quota ledger.")
+            self.db.rollback()
+            text_me_then_quit()
+        finally:
+            self.db.close()
+
+
+class DbWriter:
+    # Write-behind buffer for everything the crawl saves: new channels, their keyword tags (and new search
+    # keywords for channels we already have), completed searches (and their SearchTasks), refreshed channel
+    # statistics, and discovery expansion's candidates and progress.  These get committed together in one transaction once WRITE_BATCH_ROWS rows or
+    # WRITE_BATCH_SECONDS have built up, instead of one commit (and fsync) per row.
+    # Everything in a batch commits or nothing does, and rows are only ever added after the rows they depend on
+    # (a Search after all its channels), so a Search row still never gets committed before its channels.
+
+    def __init__(self, max_rows=WRITE_BATCH_ROWS, max_seconds=WRITE_BATCH_SECONDS):
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.channels = []          # new Channel rows, as tuples of the CHANNEL_COLUMNS
+        self.keywords = set()       # (channel_id, keyword, source) tags to add
+        self.searches = []          # completed Search rows
+        self.tasks_done = []        # their SearchTasks' updates, dicts of SearchTask columns by primary key
+        self.stats = []             # refreshed statistics, dicts of Channel columns by primary key
+        self.candidates = {}        # channel_id -> [score, mentions, found_via] to add to its ChannelCandidate
+        self.expanded = []          # channels expanded, dicts of Channel columns by primary key
+        self.candidates_done = []   # candidates looked up, dicts of ChannelCandidate columns by primary key
+        self.oldest = None          # time.monotonic() of the first row waiting to be written
+
+    def pending_rows(self):
+        return (len(self.channels) + len(self.keywords) + len(self.searches) + len(self.stats) + len(self.candidates)
+                + len(self.expanded) + len(self.candidates_done))
+
+    def touch(self):
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+
+    def add_channel(self, channel):
+        self.channels.append(channel)
+        self.touch()
+
+    def add_keywords(self, channel_id, keywords, source):
+        self.keywords.update((channel_id, keyword, source) for keyword in keywords)
+        self.touch()
+
+    def add_search(self, search, task_done):
+        self.searches.append(search)
+        self.tasks_done.append(task_done)
+        self.touch()
+
+    def add_stats(self, stats):
+        self.stats.append(stats)
+        self.touch()
+
+    def add_candidates(self, channel_ids, found_via, score):
+        for channel_id in channel_ids:
+            candidate = self.candidates.setdefault(channel_id, [0.0, 0, found_via])
+            candidate[0] += score
+            candidate[1] += 1
+        self.touch()
+
+    def add_expanded(self, id, expanded_at):
+        self.expanded.append({'id': id, 'expanded_at': expanded_at})
+        self.touch()
+
+    def add_candidate_done(self, id, status):
+        self.candidates_done.append({'id': id, 'status': status})
+        self.touch()
+
+    def maybe_flush(self):
+        if self.pending_rows() >= self.max_rows or (self.oldest is not None and time.monotonic() - self.oldest >= self.max_seconds):
+            self.flush()
+
+    def flush(self):
+        if not self.pending_rows():
+            return
+
+        started = time.monotonic()
+        try:
+            # New channels have to be in before tagging them.  Upserted, since another crawl worker (see --workers)
+            # can find and save the same channel at the same time, in which case the later reading wins.
+            upsert_channels(self.channels)
+            insert_channel_keywords(self.keywords)
+            if self.searches:
+                session.execute(insert(Search.__table__).prefix_with("OR IGNORE"), self.searches)
+            if self.tasks_done:
+                session.execute(update(SearchTask), self.tasks_done)
+
+            # Every reading of a channel's statistics goes in the history, including the first one
+            if self.stats:
+                session.execute(update(Channel), self.stats)    # bulk UPDATE by primary key
+                snapshots = [ stat_snapshot(s['id'], s['stats_updated_at'], s['subscriber_count'], s['view_count'], s['video_count'])
+                              for s in self.stats if 'subscriber_count' in s ]
+                if snapshots:
+                    session.execute(insert(ChannelStatSnapshot.__table__), snapshots)
+
+            # After the channels, so ones that just got saved don't become candidates
+            if self.candidates:
+                now = utc_timestamp()
+                session.execute(text(UPSERT_CANDIDATE_SQL), [ {'channel_id': channel_id, 'score': score, 'mentions': mentions, 'found_via': found_via,
+                                                               'status': CANDIDATE_PENDING, 'found_at': now}
+                                                              for channel_id, (score, mentions, found_via) in self.candidates.items() ])
+            if self.expanded:
+                session.execute(update(Channel), self.expanded)
+            if self.candidates_done:
+                session.execute(update(ChannelCandidate), self.candidates_done)
+
+            session.commit()
+        except Exception as e:
+            print(f"Exception {e} when trying to save {len(self.channels)} channels, {len(self.keywords)} keyword tags, {len(self.searches)} searches and {len(self.stats)} stats updates.")
+            session.rollback()
+            text_me_then_quit()
+        finally:
+            session.close()
+
+        seconds = time.monotonic() - started
+        expansion = ""
+        rows = {'channels': len(self.channels), 'keyword_tags': len(self.keywords), 'searches': len(self.searches), 'stats': len(self.stats)}
+        if self.expanded or self.candidates_done:
+            expansion = f" (expanded {len(self.expanded)} channels, looked up {len(self.candidates_done)} candidates)"
+            rows.update(expanded=len(self.expanded), candidates_looked_up=len(self.candidates_done))
+        if self.candidates:
+            rows.update(candidates=len(self.candidates))
+        print(f"Committed {len(self.channels)} channels, {len(self.keywords)} keyword tags, {len(self.searches)} searches and {len(self.stats)} stats updates{expansion} in {seconds:.3f}s")
+        metrics.observe("db_commit_seconds", seconds, buckets=COMMIT_BUCKETS)
+        for kind, count in rows.items():
+            metrics.inc("db_rows_committed_total", count, kind=kind)
+        metrics.event("commit", seconds=round(seconds, 4), **rows)
+        metrics.maybe_write()
+        self.channels = []
+        self.keywords = set()
+        self.searches = []
+        self.tasks_done = []
+        self.stats = []
+        self.candidates = {}
+        self.expanded = []
+        self.candidates_done = []
+        self.oldest = None
+
+
+# A mention of a channel we don't have yet, adding to its score if it's already a candidate
+UPSERT_CANDIDATE_SQL = """
+    INSERT INTO ChannelCandidate (channel_id, score, mentions, found_via, status, found_at)
+    SELECT :channel_id, :score, :mentions, :found_via, :status, :found_at
+    WHERE NOT EXISTS (SELECT 1 FROM Channel WHERE Channel.channel_id = :channel_id)
+    ON CONFLICT (channel_id) DO UPDATE SET score = score + excluded.score, mentions = mentions + excluded.mentions
+"""
+
+
+def stat_snapshot(id, taken_at, subscriber_count, view_count, video_count):
+    # A ChannelStatSnapshot row, as a dict for bulk inserting
+    return {'channel_id': id, 'taken_at': taken_at, 'subscriber_count': subscriber_count, 'view_count': view_count, 'video_count': video_count}
+
+
+def upsert_channels(channels):
+    # Insert new channels (row tuples of the CHANNEL_COLUMNS), or update the ones that are already there if their etag
+    # says they changed, along with a ChannelStatSnapshot for each one that got written (looking the Channel ids up in
+    # the same statement, like insert_channel_keywords()).  Leaving the unchanged ones alone means the search index and
+    # Channel.updated_at (see yt_query.py and yt_export.py) don't see a change either.  Rows without an etag (from
+    # responses cached before etags were asked for) always get updated.
+    if not channels:
+        return
+
+    upsert = sqlite_insert(Channel.__table__)
+    session.execute(upsert.on_conflict_do_update(index_elements=['channel_id'], set_={ name: upsert.excluded[name] for name in CHANNEL_COLUMNS if name != 'channel_id' },
+                                                 where=or_(upsert.excluded.etag.is_(None), Channel.__table__.c.etag.is_distinct_from(upsert.excluded.etag))),
+                    [ dict(zip(CHANNEL_COLUMNS, channel)) for channel in channels ])
+
+    stats_updated_at = CHANNEL_COLUMNS.index('stats_updated_at')
+    session.execute(
+        insert(ChannelStatSnapshot.__table__).from_select(
+            ['channel_id', 'taken_at', 'subscriber_count', 'view_count', 'video_count'],
+            select(Channel.id, Channel.stats_updated_at, Channel.subscriber_count, Channel.view_count, Channel.video_count)
+            .where(Channel.channel_id == bindparam('b_channel_id'), Channel.stats_updated_at == bindparam('b_taken_at'))
+        ),
+        [ {'b_channel_id': channel[0], 'b_taken_at': channel[stats_updated_at]} for channel in channels ]
+    )
+
+
+def quota_pool(pool, key_name):
+    # Each key has its own quota, so its own pools.  The default key's keep the plain names they always had.
+    return pool if key_name == DEFAULT_KEY else f"{pool}:{key_name}"
+
+
+def utc_timestamp():
+    # Same format as the API's publishedAt, e.g. "2020-07-04T18:30:00Z"
+    return datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def insert_channel_keywords(tags):
+    # Tag channels with keywords, given (channel_id, keyword, source) tuples.  These are all idempotent inserts, so
+    # there's nothing to read first and tagging a channel with something it already has just does nothing:
+    # add any new keywords to Keyword, then add the tags, looking the ids up in the same statement.
+    if not tags:
+        return
+
+    keywords = { keyword for (channel_id, keyword, source) in tags }
+    session.execute(insert(Keyword.__table__).prefix_with("OR IGNORE"), [ {'keyword': keyword} for keyword in keywords ])
+
+    session.execute(
+        insert(ChannelKeyword.__table__).prefix_with("OR IGNORE").from_select(
+            ['channel_id', 'keyword_id', 'source'],
+            select(Channel.id, Keyword.id, bindparam('b_source', type_=String()))
+            .join(Keyword, Keyword.keyword == bindparam('b_keyword'))
+            .where(Channel.channel_id == bindparam('b_channel_id'))
+        ),
+        [ {'b_channel_id': channel_id, 'b_keyword': keyword, 'b_source': source} for (channel_id, keyword, source) in tags ]
+    )
+
+
+def migrate_channel_keywords(chunk_size=5000):
+    # One-off conversion of the old comma-separated Channel.keywords strings into Keyword/ChannelKeyword rows.
+    # Each converted row gets its keywords set to NULL in the same transaction, so this only does anything the first
+    # time it runs on an old DB, and picks up where it left off if it gets interrupted.
+    # The old strings didn't record where each keyword came from, so any keyword that's one of our search keywords
+    # gets tagged as from a search, and the rest as the creator's own.
+    if not session.query(Channel.id).filter(Channel.keywords.isnot(None)).first():
+        session.close()
+        return
+
+    # Work the search keywords back out of the saved search terms, e.g. "q=best%20cooktops&type=video" -> "cooktops"
+    search_keywords = set()
+    for (search_term,) in session.query(Search.search):
+        keyword = urlunquote(search_term[len("q="):].split('&')[0])
+        for key, value in SEARCH_MODIFIERS.items():
+            if value['pre_or_post'] == "pre" and keyword.startswith(key):
+                keyword = keyword[len(key):]
+            elif value['pre_or_post'] == "post" and keyword.endswith(key):
+                keyword = keyword[:-len(key)]
+        search_keywords.add(keyword)
+
+    print("Converting old Channel.keywords to ChannelKeyword rows...")
+    converted = 0
+    while True:
+        rows = session.query(Channel.id, Channel.channel_id, Channel.keywords).filter(Channel.keywords.isnot(None)).limit(chunk_size).all()
+        if not rows:
+            break
+
+        tags = set()
+        for id, channel_id, keywords in rows:
+            for keyword in keywords.split(','):
+                if keyword:
+                    tags.add((channel_id, keyword, KEYWORD_SOURCE_SEARCH if keyword in search_keywords else KEYWORD_SOURCE_CREATOR))
+
+        try:
+            insert_channel_keywords(tags)
+            session.execute(update(Channel), [ {'id': id, 'keywords': None} for (id, channel_id, keywords) in rows ])
+            session.commit()
+        except Exception as e:
+            print(f"Exception {e} when trying to convert channel keywords.")
+            session.rollback()
+            text_me_then_quit()
+        finally:
+            session.close()
+
+        converted += len(rows)
+        print(f"  ..converted {converted} channels")
+
+
+def add_missing_columns(engine, model):
+    # create_all() only creates missing tables, so add any columns that are newer than an existing table
+    existing = { column['name'] for column in inspect(engine).get_columns(model.__tablename__) }
+    with engine.begin() as conn:
+        for column in model.__table__.columns:
+            if column.name not in existing:
+                print(f"Adding column {model.__tablename__}.{column.name}")
+                conn.exec_driver_sql(f'ALTER TABLE "{model.__tablename__}" ADD COLUMN "{column.name}" {column.type.compile(dialect=engine.dialect)}')
+
+
+def migrate_quota_ledger(engine):
+    # QuotaLedger used to have one row per day (with quota_day unique), now it's one per day per quota pool.
+    # SQLite can't drop a unique constraint, so copy it over to a new table, the old rows all being the crawl's.
+    existing = { column['name'] for column in inspect(engine).get_columns(QuotaLedger.__tablename__) }
+    if 'pool' in existing:
+        return
+    with engine.begin() as conn:
+        conn.exec_driver_sql('ALTER TABLE "QuotaLedger" RENAME TO "QuotaLedger_old"')
+        QuotaLedger.__table__.create(conn)
+        conn.execute(text('INSERT INTO "QuotaLedger" (quota_day, pool, credits_used) SELECT quota_day, :pool, credits_used FROM "QuotaLedger_old"'),
+                     {'pool': QUOTA_POOL_DISCOVERY})
+        conn.exec_driver_sql('DROP TABLE "QuotaLedger_old"')
+
+
+def load_known():
+    # Load every channel_id and search term already in the DB once at startup, so checking whether we already have
+    # one is just a set lookup instead of a SELECT per search result/search term.  Kept up to date as rows get saved.
+    # (A set of ~24 char ids is ~100 bytes each, so this is fine up to a few million channels)
+    known_channels = { channel_id for (channel_id,) in session.query(Channel.channel_id).yield_per(10000) }
+    searched_terms = { search for (search,) in session.query(Search.search).yield_per(10000) }
+    session.close()
+    return known_channels, searched_terms
+
+
+def planned_searches():
+    # Yields (query, search_type, search_keyword) for every search in the keywords file, e.g.
+    # ("best appliance warranties", "video", "appliance warranties").  Goes through the file once, then the
+    # modifiers in order and the keywords on the inner loop, for a breadth-first search instead of depth-first
+    # (the order the queue falls back on when the tasks are otherwise tied, see lease_next_search()).
+    with open(KEYWORD_CSV_FILE, 'r') as f_keywords_r:
+        csv_reader = csv.reader(f_keywords_r, delimiter=',')
+        next(csv_reader, None)  # Skip headers
+        rows = list(csv_reader)
+
+    for key, value in SEARCH_MODIFIERS.items():
+        for row in rows:
+            # If this modifier (key) is true for this row, apply the search term
+            # e.g. if key="best" then looks for a TRUE in the "best" column of the keywords file.
+            if row[ value['col'] ] != "TRUE":
+                continue
+
+            keyword = row[KEYWORD_COL].lower().strip()     # Keyword doesn't include the search modifier
+
+            # Determine if prefix or postfix to search query
+            if value['pre_or_post'] == "pre":
+                query = key + keyword       # e.g. "best appliance warranties"
+            elif value['pre_or_post'] == "post":
+                query = keyword + key       # e.g. "appliances reviews"
+            else:
+                # Should not get here!
+                print("Error in pre/post logic!")
+                print(f"key: {key} value['col']: {value['col']} value['pre_or_post']: {value['pre_or_post']}")
+                print(f"row: {row}")
+                print("Aborting script.")
+                text_me_then_quit()
+
+            # The search type, "channels" or "videos"
+            if row[TYPE_COL] == "videos":
+                search_type = "video"
+            elif row[TYPE_COL] == "channels":
+                search_type = "channel"
+            else:
+                # Should not get here!
+                print("Error in video/channel type!")
+                print(f"keyword: {keyword}")
+                print(f"row[TYPE_COL]: {row[TYPE_COL]}")
+                print("Aborting script.")
+                text_me_then_quit()
+
+            yield query, search_type, keyword
+
+
+def search_term(query, search_type, page_token=''):
+    # The search's URL parameters, which is also what goes in the Search table, e.g. "q=best%20appliance%20warranties&type=video"
+    # We url encode the query, but not the q= or & terms, we don't want those escaped!
+    term = f"q={urlquote(query)}&type={search_type}"
+    if page_token:
+        term += f"&pageToken={page_token}"
+    return term
+
+
+def sync_search_tasks(searched_terms):
+    # Add a SearchTask for every search in the keywords file that isn't in the queue yet, so new rows in the file
+    # get picked up.  Searches that an older version of this script already did (that are in the Search table but
+    # not the queue) go in as done.
+    tasks = [ {'query': query, 'search_type': search_type, 'keyword': keyword, 'page': 1, 'page_token': '',
+               'status': TASK_DONE if search_term(query, search_type) in searched_terms else TASK_PENDING}
+              for (query, search_type, keyword) in planned_searches() ]
+    if not tasks:
+        return
+    try:
+        result = session.execute(insert(SearchTask.__table__).prefix_with("OR IGNORE"), tasks)
+        session.commit()
+    except Exception as e:
+        print(f"Exception {e} when trying to add search tasks.")
+        session.rollback()
+        text_me_then_quit()
+    finally:
+        session.close()
+    print(f"Added {result.rowcount} new searches from {KEYWORD_CSV_FILE} to the search queue.")
+
+
+# Picks the pending task with the most expected new channels per 100 credits (see SEARCH_PRIOR_NEW), counting the
+# channel lookups for them as well as the search.  Leases past their expiry count as pending.
+NEXT_SEARCH_SQL = """
+    WITH first_pages AS (
+        SELECT keyword, SUM(new_channels) AS new_channels, COUNT(*) AS searches FROM SearchTask
+        WHERE status = :done AND page = 1 AND new_channels IS NOT NULL
+        GROUP BY keyword
+    ), first_page AS (
+        SELECT (COALESCE(SUM(new_channels), 0) + :prior_new * :prior_weight) / (COALESCE(SUM(searches), 0) + :prior_weight) AS expected
+        FROM first_pages
+    ), page_decay AS (
+        SELECT (COALESCE(SUM(new_channels), 0) + :decay_prior * :decay_weight) / (COALESCE(SUM(parent_new_channels), 0) + :decay_weight) AS decay
+        FROM SearchTask WHERE status = :done AND page > 1 AND new_channels IS NOT NULL
+    ), expected AS (
+        SELECT SearchTask.id, SearchTask.query, SearchTask.search_type, SearchTask.keyword, SearchTask.page, SearchTask.page_token,
+               CASE WHEN SearchTask.page > 1 THEN SearchTask.parent_new_channels * page_decay.decay
+                    ELSE (COALESCE(first_pages.new_channels, 0) + first_page.expected * :prior_weight) / (COALESCE(first_pages.searches, 0) + :prior_weight)
+               END AS expected_new
+        FROM SearchTask CROSS JOIN first_page CROSS JOIN page_decay
+        LEFT JOIN first_pages ON first_pages.keyword = SearchTask.keyword
+        WHERE (SearchTask.status = :pending OR (SearchTask.status = :leased AND SearchTask.lease_expires_at < :now))
+          AND SearchTask.id NOT IN :skipped
+    )
+    SELECT *, expected_new * 100.0 / (:search_cost + expected_new * :channel_cost / :batch_size) AS new_per_100_credits
+    FROM expected
+    ORDER BY new_per_100_credits DESC, id
+    LIMIT 1
+"""
+
+
+def lease_next_search():
+    # Take the best task off the queue (see NEXT_SEARCH_SQL) and lease it for SEARCH_LEASE (renewed by
+    # keep_leases() for as long as this crawl is running).  Returns None once there's nothing left to search.
+    # Crawl workers (--workers) all take from the same queue, and only one of them can get each task.
+    while True:
+        now = utc_timestamp()
+        try:
+            task = session.execute(text(NEXT_SEARCH_SQL).bindparams(bindparam('skipped', expanding=True)), {
+                'done': TASK_DONE, 'pending': TASK_PENDING, 'leased': TASK_LEASED, 'now': now,
+                'skipped': list(skipped_tasks) or [-1],
+                'prior_new': SEARCH_PRIOR_NEW, 'prior_weight': SEARCH_PRIOR_WEIGHT,
+                'decay_prior': PAGE_DECAY_PRIOR, 'decay_weight': PAGE_DECAY_PRIOR_WEIGHT,
+                'search_cost': SEARCH_COST, 'channel_cost': CHANNEL_COST, 'batch_size': CHANNEL_BATCH_SIZE,
+            }).first()
+            if task is None:
+                return None
+
+            # Only take it if it's still up for grabs
+            lease_expires_at = (datetime.now(timezone.utc) + SEARCH_LEASE).strftime('%Y-%m-%dT%H:%M:%SZ')
+            leased = session.execute(text("""
+                UPDATE SearchTask SET status = :leased, lease_expires_at = :lease_expires_at, leased_by = :worker
+                WHERE id = :id AND (status = :pending OR (status = :leased AND lease_expires_at < :now))
+            """), {'id': task.id, 'leased': TASK_LEASED, 'pending': TASK_PENDING, 'lease_expires_at': lease_expires_at,
+                   'worker': WORKER_ID, 'now': now}).rowcount
+            session.commit()
+        except Exception as e:
+            print(f"Exception {e} when trying to lease the next search.")
+            session.rollback()
+            text_me_then_quit()
+        finally:
+            session.close()
+
+        if leased:
+            print(f"Next search: {task.query!r} ({task.search_type}s, page {task.page}), expecting {task.new_per_100_credits:.1f} new channels per 100 credits")
+            return task
+
+
+def release_search(task):
+    # Put a leased task back in the queue without doing it
+    try:
+        session.execute(update(SearchTask), [{'id': task.id, 'status': TASK_PENDING, 'lease_expires_at': None, 'leased_by': None}])
+        session.commit()
+    except Exception as e:
+        print(f"Exception {e} when trying to release search task {task.id}.")
+        session.rollback()
+        text_me_then_quit()
+    finally:
+        session.close()
+
+
+def keep_leases(stop):
+    # Runs in its own thread (with its own DB session) for the whole crawl, pushing back the expiry of the tasks this
+    # crawl has leased every LEASE_RENEW_SECONDS.  If the crawl dies, this stops with it and its tasks go back in the
+    # queue SEARCH_LEASE later, for whichever crawl worker gets to them first.
+    db = Session()
+    while not stop.wait(LEASE_RENEW_SECONDS):
+        lease_expires_at = (datetime.now(timezone.utc) + SEARCH_LEASE).strftime('%Y-%m-%dT%H:%M:%SZ')
+        try:
+            db.execute(update(SearchTask).where(SearchTask.status == TASK_LEASED, SearchTask.leased_by == WORKER_ID)
+                       .values(lease_expires_at=lease_expires_at))
+            db.commit()
+        except Exception as e:
+            # Not fatal, just try again next time (the leases have a few renewals' worth of slack)
+            print(f"Exception {e} when trying to renew search task leases.")
+            db.rollback()
+        finally:
+            db.close()
+
+
+def release_leases():
+    # Put the tasks this crawl still has leased back in the queue on the way out (including when aborting), so
+    # other crawl workers don't have to wait for the leases to run out.  Their results weren't saved, so they get redone.
+    db = Session()
+    try:
+        released = db.execute(update(SearchTask).where(SearchTask.status == TASK_LEASED, SearchTask.leased_by == WORKER_ID)
+                              .values(status=TASK_PENDING, lease_expires_at=None, leased_by=None)).rowcount
+        db.commit()
+    except Exception as e:
+        print(f"Exception {e} when trying to release search task leases.")
+        db.rollback()
+        return
+    finally:
+        db.close()
+    if released:
+        print(f"Put {released} unfinished searches back in the search queue.")
+
+
+def worker_command(crawl_argv, key_name):
+    # The command line for one crawl worker process: this crawl's arguments, with its own key instead of --workers
+    command = [sys.executable, os.path.abspath(__file__), "crawl"]
+    argv = iter(crawl_argv)
+    for arg in argv:
+        if arg in ("--workers", "--key"):
+            next(argv, None)    # and its value
+        elif not arg.startswith(("--workers=", "--key=")):
+            command.append(arg)
+    return command + ["--key", key_name]
+
+
+def run_workers(num_workers, crawl_argv):
+    # Start a crawl worker process for each of the first num_workers keys in API_KEYS, and wait for them all.
+    # They share the search queue (and everything else in the DB), and each spends its own key's quota.
+    # Raises CrawlAborted if any of them failed (each one has already sent its own alert).
+    key_names = list(API_KEYS)[:num_workers]
+    if len(key_names) < num_workers:
+        print(f"Only have {len(key_names)} API keys, can't run {num_workers} workers (add more to API_KEYS)")
+        text_me_then_quit()
+
+    workers = {}
+    for key_name in key_names:
+        workers[key_name] = subprocess.Popen(worker_command(crawl_argv, key_name))
+        print(f"Started crawl worker for key {key_name} (pid {workers[key_name].pid})")
+
+    failed = []
+    for key_name, worker in workers.items():
+        worker.wait()
+        print(f"Crawl worker for key {key_name} finished (exit code {worker.returncode})")
+        if worker.returncode != 0:
+            failed.append(key_name)
+    if failed:
+        raise CrawlAborted(f"{len(failed)} of {num_workers} crawl workers failed (keys {', '.join(failed)}).")
+
+
+def queue_next_page(task, json_response, new_channels):
+    # Add the next page of a search to the queue, if there is one and this page found anything new.  Goes in right
+    # away (not with the write batch) so it can be picked next; if this page then doesn't get saved, it gets
+    # redone and this just does nothing the second time.
+    next_page_token = json_response.get('nextPageToken')
+    if not next_page_token or task.page >= MAX_SEARCH_PAGES or new_channels == 0:
+        return
+    try:
+        session.execute(insert(SearchTask.__table__).prefix_with("OR IGNORE"), [{
+            'query': task.query, 'search_type': task.search_type, 'keyword': task.keyword, 'page': task.page + 1,
+            'page_token': next_page_token, 'parent_new_channels': new_channels, 'status': TASK_PENDING,
+        }])
+        session.commit()
+    except Exception as e:
+        print(f"Exception {e} when trying to queue the next page of search task {task.id}.")
+        session.rollback()
+        text_me_then_quit()
+    finally:
+        session.close()
+
+
+def fetch_search(task):
+    # Returns the search response, from the response cache if it's there.  With --replay, returns None for
+    # searches that aren't cached instead of sending them.
+    term = search_term(task.query, task.search_type, task.page_token)
+
+    # Build rest of URL for the "search" command
+    url = f'{API_BASE_URL}search?{partial_response(SEARCH_ITEM_FIELDS, SEARCH_RESPONSE_FIELDS)}&maxResults=50&{term}&key={API_KEY}'
+
+    json_response = cache.get(url, ignore_ttl=args.replay)
+    if json_response is not None:
+        print(f"Searching on search term: {term} (cached)")
+        return json_response
+    if args.replay:
+        print(f"Not in the response cache, skipping search term: {term}")
+        return None
+
+    # Searched before (the cached response expired), the results only get downloaded again if they changed
+    print(f"Searching on search term: {term}")
+    json_response, changed = api_get_revalidated(url, "youtube#searchListResponse", SEARCH_COST)
+    return json_response
+
+
+def channel_url(channel_ids):
+    return f'{API_BASE_URL}channels?{partial_response(CHANNEL_ITEM_FIELDS, CHANNEL_RESPONSE_FIELDS)}&id={"%2C".join(channel_ids)}&key={API_KEY}'
+
+
+def fetch_channel_batch(batch_ids):
+    # Returns a channels.list response for the batch.  Channels are cached one per entry (batches come out different
+    # every run), so only the ones that aren't in the response cache get looked up.  With --replay, the ones that
+    # aren't cached are just left out, same as channels the API doesn't return.
+    items = []
+    to_fetch = []
+    for channel_id in batch_ids:
+        cached = cache.get(channel_url([channel_id]), ignore_ttl=args.replay)
+        if cached is None:
+            to_fetch.append(channel_id)
+        else:
+            items += cached.get('items', [])
+
+    if to_fetch and not args.replay:
+        print(f"Looking up batch of {len(to_fetch)} channels ({len(batch_ids) - len(to_fetch)} cached)")
+        json_response = api_get(channel_url(to_fetch), "youtube#channelListResponse", CHANNEL_COST)
+        fetched = { item['id']: item for item in json_response.get('items', []) }
+        for channel_id in to_fetch:
+            # Cache the ones that didn't come back too, so a replay knows they're gone
+            item = fetched.get(channel_id)
+            cache.put(channel_url([channel_id]), {'kind': "youtube#channelListResponse", 'items': [item] if item else []})
+        items += fetched.values()
+    else:
+        print(f"Looking up batch of {len(batch_ids)} channels (all cached)")
+
+    return {'kind': "youtube#channelListResponse", 'items': items}
+
+
+def queue_search_results(task, json_response):
+    # Tag the channels we already have with this search's keyword, and queue up the new ones to be looked up
+    search_keyword = task.keyword
+    term = search_term(task.query, task.search_type, task.page_token)
+
+    # Number of results to further search on
+    num_results = len(json_response.get('items', []))
+    print(f"Got {num_results} results for search term: {term}")
+
+    waiting_on = set()      # New channels this search has to wait on before it counts as complete
+    new_channels = set()    # Channels that nothing before this search found, for the search queue's estimates
+    seen = set()            # This search's channels so far, a video search can have several videos from one channel
+    known = queued_already = duplicates = 0
+
+    # Other crawl workers (see --workers) may have saved some of these since we loaded known_channels
+    results = [ extract_fields(item, SEARCH_ITEM_FIELDS) for item in json_response.get('items', []) ]
+    known_channels.update(saved_channels({ channel_id for (kind, channel_id) in results } - known_channels))
     
-    return out
+    for kind, channel_id in results:
+        if kind != "youtube#searchResult":
+            print(f"Fatal Error, each item should be kind=youtube#searchResult, but got kind={kind}")
+            text_me_then_quit()
+
+        if channel_id in seen:
+            duplicates += 1
+            continue
+        seen.add(channel_id)
+
+        queued = pending_channels.get(channel_id) or in_flight_channels.get(channel_id)
+        if queued:
+            # Already queued up for lookup by an earlier search, just tag it with this keyword too
+            queued.add(search_keyword)
+            waiting_on.add(channel_id)
+            queued_already += 1
+            continue
+        
+        # Check if we've already searched for this channel_id before, if it's in the Channel table.
+        if channel_id in known_channels:
+            # If we've already searched on this channel, we don't want to search again.
+            # But we do want to add that search term to its list of keywords (merged in with the next write batch)
+            writer.add_keywords(channel_id, [search_keyword], KEYWORD_SOURCE_SEARCH)
+            print(f"  ..Adding keywords for previously-saved channel {channel_id}")
+            known += 1
+
+        else:
+            # In this case, we haven't searched on this channel before.  Queue it up to grab all
+            # data related to it in the next batch lookup.
+            pending_channels[channel_id] = {search_keyword}
+            waiting_on.add(channel_id)
+            new_channels.add(channel_id)
+
+    # How much this search was worth (see yt_metrics.py).  "queued" are new channels that an earlier search in this
+    # run found too (and hasn't finished looking up), "duplicate" are this search's own repeats of a channel.
+    for outcome, count in (("new", len(new_channels)), ("known", known), ("queued", queued_already), ("duplicate", duplicates)):
+        metrics.inc("search_results_total", count, search_type=task.search_type, outcome=outcome)
+    metrics.inc("searches_total", search_type=task.search_type)
+    metrics.event("search", term=term, keyword=search_keyword, search_type=task.search_type, page=task.page,
+                  results=num_results, new=len(new_channels), known=known, queued=queued_already, duplicate=duplicates)
+
+    queue_next_page(task, json_response, len(new_channels))
+
+    # If we get here, we've queued up all the (50 max) channels for that particular modified keyword search.
+    # Its progress gets saved to the Search table (and its task marked done) once they've all been looked up.
+    completed_search = dict(
+        search=term,
+        num_results=num_results,
+        etag=json_response.get('etag')
+    )
+    task_done = {'id': task.id, 'status': TASK_DONE, 'lease_expires_at': None, 'num_results': num_results,
+                 'new_channels': len(new_channels), 'completed_at': utc_timestamp()}
+    pending_searches.append((completed_search, task_done, waiting_on))
+
+
+def saved_channels(channel_ids):
+    # Which of these channel_ids are in the Channel table
+    if not channel_ids:
+        return set()
+    saved = { channel_id for (channel_id,) in session.query(Channel.channel_id).filter(Channel.channel_id.in_(channel_ids)) }
+    session.close()
+    return saved
+
+
+def next_channel_batch(flush_all=False):
+    # Take the next batch of up to CHANNEL_BATCH_SIZE queued-up channels to look up (same 1 credit whether we ask
+    # for 1 id or 50).  Normally only hands out full batches, so partial batches can fill up from the next search.
+    # flush_all=True hands out whatever is left, e.g. at the end of the crawl.  Returns None if there's no batch.
+    if len(pending_channels) < CHANNEL_BATCH_SIZE and not (flush_all and pending_channels):
+        return None
+
+    batch_ids = list(pending_channels)[:CHANNEL_BATCH_SIZE]
+    for channel_id in batch_ids:
+        in_flight_channels[channel_id] = pending_channels.pop(channel_id)   # Still counts as queued until it's saved
+    return batch_ids
+
+
+def save_channel_batch(batch_ids, json_response):
+    # Save the channels from a channels.list response for one batch
+    global channels_grabbed
+
+    # Results don't necessarily come back in the order we asked for them, and deleted/terminated
+    # channels are just left out (in which case there's no "items" key at all if none came back)
+    items = { item['id']: item for item in json_response.get('items', []) }
+
+    for channel_id in batch_ids:
+        search_keywords = in_flight_channels.pop(channel_id)
+        item = items.get(channel_id)
+        if item is None:
+            # Don't make this a fatal error, just move along to next channel
+            print(f"  ..No channel returned for id {channel_id} (deleted or terminated?), skipping.")
+            continue
+
+        # Add the channel to the DB (with the next write batch), tagged with its own keywords plus the
+        # keyword(s) of our searches that found it
+        new_channel, creator_keywords, featured_channels = parse_channel(item)
+        writer.add_channel(new_channel)
+        writer.add_keywords(channel_id, creator_keywords, KEYWORD_SOURCE_CREATOR)
+        writer.add_keywords(channel_id, search_keywords, KEYWORD_SOURCE_SEARCH)
+        add_candidates(channel_id, featured_channels, "featured", set(creator_keywords) | search_keywords)
+        known_channels.add(channel_id)
+        channels_grabbed += 1
+        metrics.inc("channels_saved_total")
+        print(f"  Saving results for channel {new_channel[1]}")     # (its title)
+
+    # These channels are done now, whether or not the API knew about them
+    for completed_search, task_done, waiting_on in pending_searches:
+        waiting_on.difference_update(batch_ids)
+
+
+def save_completed_searches():
+    # A Search is only saved once all of its channels are, so an interrupted crawl just redoes that search.
+    # The writer commits everything in the order it was added, so its channels go in the same or an earlier commit.
+    while pending_searches and not pending_searches[0][2]:
+        completed_search, task_done, waiting_on = pending_searches.pop(0)
+
+        # Add to Search progress table
+        writer.add_search(completed_search, task_done)
+        print(f"Saving results for search term: {completed_search['search']}\n")
+
+
+def resolve_channel_batches(flush_all=False):
+    # Look up and save the queued-up new channels a batch at a time, then save any searches that are now complete.
+    while True:
+        batch_ids = next_channel_batch(flush_all)
+        if batch_ids is None:
+            break
+        save_channel_batch(batch_ids, fetch_channel_batch(batch_ids))
+
+    save_completed_searches()
+
+
+def crawl():
+    # Plain one-request-at-a-time crawl, until the search queue runs out
+    while True:
+        task = lease_next_search()
+        if task is None:
+            break
+        json_response = fetch_search(task)
+        if json_response is None:
+            # Replaying and it's not cached
+            release_search(task)
+            skipped_tasks.add(task.id)
+            continue
+        queue_search_results(task, json_response)
+
+        # Look up any full batches of channels, which saves whatever searches that completes
+        resolve_channel_batches()
+
+        writer.maybe_flush()
+
+    # Look up the last partial batch of channels and save the last searches
+    resolve_channel_batches(flush_all=True)
+    writer.flush()
+
+
+def crawl_concurrent(search_workers=SEARCH_WORKERS, channel_workers=CHANNEL_WORKERS):
+    # Producer/consumer version of crawl():
+    #   search workers  -> send the searches and hand the results to the writer
+    #   writer (this thread, the only one that touches the DB) -> queues up new channels into batches and saves everything
+    #   channel workers -> look up the batches of channels and hand the results back to the writer
+    # Every request still waits its turn on the shared quota scheduler, so this runs at the same global rate
+    # limit, but a request stuck retrying/backing off only holds up its own worker.
+
+    # The writer hands out the searches too, one per search worker at a time, so each one is the best task
+    # there is at the time (the searches that come back add their next pages to the queue).
+    search_queue = queue.Queue()
+    channel_queue = queue.Queue()
+    results = queue.Queue()         # (what, task, json_response) from the workers to the writer
+    abort = threading.Event()
+
+    def worker(work_queue, what, fetch):
+        try:
+            while not abort.is_set():
+                task = work_queue.get()
+                if task is None:
+                    break
+                results.put((what, task, fetch(task)))
+        except CrawlAborted:
+            # text_me_then_quit() already sent the text, just need to stop the rest of the crawl
+            abort.set()
+        except Exception as e:
+            print(f"Exception {e} in {what} worker.")
+            traceback.print_exc()
+            abort.set()
+        finally:
+            results.put((what + " done", None, None))
+
+    # Daemon threads so that an aborted crawl doesn't wait on workers that are sleeping or blocked
+    threads = [ threading.Thread(target=worker, args=(search_queue, "search", fetch_search), daemon=True)
+                for _ in range(search_workers) ]
+    threads += [ threading.Thread(target=worker, args=(channel_queue, "channels", fetch_channel_batch), daemon=True)
+                 for _ in range(channel_workers) ]
+    for thread in threads:
+        thread.start()
+
+    searches_running = search_workers
+    searches_out = 0            # handed out and not back yet
+    searches_finished = False
+    batches_out = 0
+
+    def hand_out_searches():
+        nonlocal searches_out, searches_finished
+        while not searches_finished and searches_out < search_workers:
+            task = lease_next_search()
+            if task is None:
+                if searches_out == 0:
+                    # Nothing left, and nothing still out that could add more pages
+                    for _ in range(search_workers):
+                        search_queue.put(None)      # One "no more work" per worker
+                    searches_finished = True
+                break
+            search_queue.put(task)
+            searches_out += 1
+
+    hand_out_searches()
+    while searches_running or batches_out or pending_channels:
+        what, task, json_response = results.get()
+        if abort.is_set():
+            break
+
+        if what == "search":
+            searches_out -= 1
+            if json_response is None:
+                # Replaying and it's not cached
+                release_search(task)
+                skipped_tasks.add(task.id)
+            else:
+                queue_search_results(task, json_response)
+            hand_out_searches()
+        elif what == "channels":
+            save_channel_batch(task, json_response)
+            batches_out -= 1
+        elif what == "search done":
+            searches_running -= 1
+
+        # Hand out full batches of channels, or whatever is left once all the searches are in
+        while True:
+            batch_ids = next_channel_batch(flush_all=(searches_running == 0))
+            if batch_ids is None:
+                break
+            channel_queue.put(batch_ids)
+            batches_out += 1
+
+        save_completed_searches()
+        writer.maybe_flush()
+
+    if abort.is_set():
+        # Anything still in the writer just doesn't get saved, same as if it had crashed
+        raise CrawlAborted("Aborting crawl.")
+
+    writer.flush()
+
+    for _ in range(channel_workers):
+        channel_queue.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def pick_stale_channels(limit, due_before):
+    # The `limit` most overdue channels for a stats refresh (see REFRESH_GROWTH_WEIGHT), leaving out the ones that were
+    # read since due_before.  Channels that have never been refreshed count as the most overdue.
+    rows = session.execute(text("""
+        SELECT id, channel_id, subscriber_count, subscriber_growth, stats_updated_at, stats_etag FROM Channel
+        WHERE stats_updated_at IS NULL OR stats_updated_at < :due_before
+        ORDER BY (julianday('now') - julianday(COALESCE(stats_updated_at, '2005-01-01')))
+                 * (1 + :growth_weight * MAX(COALESCE(subscriber_growth, 0), 0) / MAX(COALESCE(subscriber_count, 0), 1)) DESC, id
+        LIMIT :limit
+    """), {'due_before': due_before, 'growth_weight': REFRESH_GROWTH_WEIGHT, 'limit': limit}).all()
+    session.close()
+    return rows
+
+
+def fetch_channel_stats(channel_ids):
+    # Just the statistics part, not cached (the point is to get new numbers, and the batches come out different
+    # every run, so there'd never be an earlier response for the same batch to revalidate)
+    url = f'{API_BASE_URL}channels?{partial_response(STATS_ITEM_FIELDS, CHANNEL_RESPONSE_FIELDS)}&id={"%2C".join(channel_ids)}&key={API_KEY}'
+
+    print(f"Refreshing statistics for batch of {len(channel_ids)} channels")
+    return api_get(url, "youtube#channelListResponse", CHANNEL_COST)
+
+
+def refresh_stats(min_age=REFRESH_MIN_AGE):
+    # Re-read the statistics of the channels we already have, most overdue first, CHANNEL_BATCH_SIZE per call.
+    # Each reading that changed updates the Channel row and gets appended to ChannelStatSnapshot.  The ones whose etag
+    # is the same as the last refresh's (Channel.stats_etag) just get marked as read, without parsing them or writing anything else.  Runs until no
+    # channel last read more than min_age before the refresh started is left.
+    global channels_refreshed, channels_unchanged
+    due_before = (datetime.now(timezone.utc) - min_age).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+    while True:
+        writer.flush()      # So the ones we just did don't get picked again
+        rows = pick_stale_channels(REFRESH_CHUNK, due_before)
+        if not rows:
+            break
+
+        for i in range(0, len(rows), CHANNEL_BATCH_SIZE):
+            batch = rows[i:i+CHANNEL_BATCH_SIZE]
+            json_response = fetch_channel_stats([ row.channel_id for row in batch ])
+            items = { item['id']: item for item in json_response.get('items', []) }
+            now = utc_timestamp()
+
+            for row in batch:
+                item = items.get(row.channel_id)
+                if item is not None and item.get('etag') is not None and item['etag'] == row.stats_etag:
+                    # Same as the last reading.  Mark it as read so it goes to the back of the line, and it didn't grow.
+                    stats = {'id': row.id, 'stats_updated_at': now}
+                    if row.subscriber_growth:
+                        stats['subscriber_growth'] = 0.0
+                    writer.add_stats(stats)
+                    channels_refreshed += 1
+                    channels_unchanged += 1
+                    metrics.inc("channels_refreshed_total", outcome="unchanged")
+                    continue
+                if item is None:
+                    # Deleted or terminated.  Still mark it as read so it goes to the back of the line
+                    writer.add_stats({'id': row.id, 'stats_updated_at': now})
+                    metrics.inc("channels_refreshed_total", outcome="missing")
+                    continue
+
+                channel_id, etag, view_count, subscriber_count, video_count = extract_fields(item, STATS_ITEM_FIELDS)
+                stats = {
+                    'id': row.id,
+                    'stats_updated_at': now,
+                    'view_count': view_count,
+                    'subscriber_count': subscriber_count,
+                    'video_count': video_count,
+                    'stats_etag': etag,
+                }
+
+                # Growth since the last reading, subscribers/day
+                if row.stats_updated_at and row.subscriber_count is not None:
+                    days = (datetime.strptime(now, '%Y-%m-%dT%H:%M:%SZ') - datetime.strptime(row.stats_updated_at, '%Y-%m-%dT%H:%M:%SZ')).total_seconds() / 86400
+                    if days > 0:
+                        stats['subscriber_growth'] = (subscriber_count - row.subscriber_count) / days
+
+                writer.add_stats(stats)
+                channels_refreshed += 1
+                metrics.inc("channels_refreshed_total", outcome="changed")
+
+            writer.maybe_flush()
+
+    writer.flush()
+
+
+def keyword_words(keywords):
+    # The words in a bunch of keywords, e.g. {"how to surf", "surfing"} -> {"how", "to", "surf", "surfing"}
+    return { word for keyword in keywords for word in keyword.split() }
+
+
+def load_our_keywords():
+    # The words of the keywords file's keywords (see SearchTask.keyword), which expansion candidates get scored on
+    words = keyword_words(keyword for (keyword,) in session.query(SearchTask.keyword).distinct())
+    session.close()
+    return words
+
+
+def add_candidates(channel_id, mentioned_ids, found_via, keywords):
+    # The channels that channel_id (tagged with `keywords`) mentions become expansion candidates, or score higher if
+    # they already are.  Each one gets EXPAND_SOURCES[found_via] for every one of our keywords that channel_id has.
+    # Channels mentioned by a channel that has nothing to do with our keywords score 0, so never get looked up.
+    new_ids = set(mentioned_ids) - known_channels - {channel_id, None}
+    if new_ids:
+        writer.add_candidates(new_ids, found_via, EXPAND_SOURCES[found_via] * len(keyword_words(keywords) & our_keywords))
+    return new_ids
+
+
+def fetch_listing(endpoint, params, item_fields, expected_kind):
+    # One page of one of the 1-credit listings discovery expansion reads (channelSections, playlists, playlistItems,
+    # commentThreads), as a list of extract_fields() tuples.  Cached like everything else.
+    url = f'{API_BASE_URL}{endpoint}?{partial_response(item_fields, LIST_RESPONSE_FIELDS)}&{params}&key={API_KEY}'
+    json_response = cache.get(url)
+    if json_response is None:
+        json_response, changed = api_get_revalidated(url, expected_kind, LIST_COST)
+    return [ extract_fields(item, item_fields) for item in json_response.get('items', []) ]
+
+
+def expand_channel(id, channel_id, keywords):
+    # Go through one channel's listings and make every other channel they mention an expansion candidate.
+    # A channel with none of our keywords would only turn up candidates that score 0, so don't spend anything on it.
+    if not keyword_words(keywords) & our_keywords:
+        writer.add_expanded(id, utc_timestamp())
+        return
+
+    print(f"Expanding channel {channel_id}")
+    mentioned = {}
+    sections = fetch_listing("channelSections", f"channelId={channel_id}", SECTION_ITEM_FIELDS, "youtube#channelSectionListResponse")
+    mentioned["sections"] = [ section_channel for (channels,) in sections for section_channel in channels ]
+
+    # Other creators' videos in its playlists
+    mentioned["playlists"] = []
+    for (playlist_id,) in fetch_listing("playlists", f"channelId={channel_id}&maxResults={EXPAND_PLAYLISTS}", PLAYLIST_ITEM_FIELDS, "youtube#playlistListResponse"):
+        videos = fetch_listing("playlistItems", f"playlistId={playlist_id}&maxResults=50", PLAYLIST_VIDEO_FIELDS, "youtube#playlistItemListResponse")
+        mentioned["playlists"] += [ owner_channel_id for (owner_channel_id,) in videos ]
+
+    comments = fetch_listing("commentThreads", f"allThreadsRelatedToChannelId={channel_id}&maxResults={EXPAND_COMMENTS}", COMMENT_ITEM_FIELDS, "youtube#commentThreadListResponse")
+    mentioned["comments"] = [ author_channel_id for (author_channel_id,) in comments ]
+
+    found = {}
+    for found_via, mentioned_ids in mentioned.items():
+        found[found_via] = len(add_candidates(channel_id, mentioned_ids, found_via, keywords))
+        metrics.inc("expand_candidates_total", found[found_via], found_via=found_via)
+    metrics.event("expand", channel=channel_id, **found)
+    writer.add_expanded(id, utc_timestamp())
+
+
+def pick_channels_to_expand(limit):
+    # The `limit` channels most worth expanding that haven't been yet: the ones the most of our searches found, then
+    # the biggest.  Returns (id, channel_id, comma-separated keywords) rows.
+    rows = session.execute(text("""
+        SELECT Channel.id, Channel.channel_id, group_concat(Keyword.keyword) AS keywords FROM Channel
+        LEFT JOIN ChannelKeyword ON ChannelKeyword.channel_id = Channel.id
+        LEFT JOIN Keyword ON Keyword.id = ChannelKeyword.keyword_id
+        WHERE Channel.expanded_at IS NULL
+        GROUP BY Channel.id
+        ORDER BY SUM(ChannelKeyword.source = :search) DESC, Channel.subscriber_count DESC
+        LIMIT :limit
+    """), {'search': KEYWORD_SOURCE_SEARCH, 'limit': limit}).all()
+    session.close()
+    return rows
+
+
+def pick_candidates(limit):
+    # The `limit` best-scoring candidates still to be looked up (leaving out any a crawl has saved since)
+    rows = session.execute(text("""
+        SELECT id, channel_id FROM ChannelCandidate
+        WHERE status = :pending AND score >= :min_score
+          AND NOT EXISTS (SELECT 1 FROM Channel WHERE Channel.channel_id = ChannelCandidate.channel_id)
+        ORDER BY score DESC
+        LIMIT :limit
+    """), {'pending': CANDIDATE_PENDING, 'min_score': EXPAND_MIN_SCORE, 'limit': limit}).all()
+    session.close()
+    return rows
+
+
+def save_candidate_batch(batch, json_response):
+    # Save the candidates from a channels.list response that have some of our keywords themselves
+    global channels_grabbed
+    items = { item['id']: item for item in json_response.get('items', []) }
+
+    for row in batch:
+        status = CANDIDATE_REJECTED
+        item = items.get(row.channel_id)
+        if item is not None:
+            new_channel, creator_keywords, featured_channels = parse_channel(item)
+            if keyword_words(creator_keywords) & our_keywords:
+                writer.add_channel(new_channel)
+                writer.add_keywords(row.channel_id, creator_keywords, KEYWORD_SOURCE_CREATOR)
+                add_candidates(row.channel_id, featured_channels, "featured", creator_keywords)
+                known_channels.add(row.channel_id)
+                channels_grabbed += 1
+                metrics.inc("channels_saved_total")
+                print(f"  Saving results for channel {new_channel[1]}")
+                status = CANDIDATE_SAVED
+        metrics.inc("candidates_looked_up_total", status=status)
+        writer.add_candidate_done(row.id, status)
+
+
+def expand(max_credits=None):
+    # Discovery expansion: alternate between expanding channels we have (turning up candidates) and looking up the
+    # best candidates, CHANNEL_BATCH_SIZE at a time.  Runs until there's no candidate worth looking up and no channel
+    # left to expand, or max_credits have been spent.
+    def out_of_credits():
+        return max_credits is not None and metrics.total("credits_spent_total") >= max_credits
+
+    while not out_of_credits():
+        writer.flush()      # So the candidates so far are all in the DB, and the ones we just did don't get picked again
+        batch = pick_candidates(CHANNEL_BATCH_SIZE)
+
+        # Lookups cost the same 1 credit for 1 channel or 50, so expand more channels until there's a full batch
+        if len(batch) < CHANNEL_BATCH_SIZE:
+            rows = pick_channels_to_expand(EXPAND_CHUNK)
+            if rows:
+                for row in rows:
+                    expand_channel(row.id, row.channel_id, (row.keywords or '').split(','))
+                    writer.maybe_flush()
+                    if out_of_credits():
+                        break
+                continue
+            if not batch:
+                break
+
+        save_candidate_batch(batch, fetch_channel_batch([ row.channel_id for row in batch ]))
+
+    writer.flush()
 
 
 #####################################
-# Main
+# Database
 #####################################
 
-# Set up database
-# engine = create_engine('sqlite:///youtube_crawl.db', echo = True) # prints commands to stdout
-engine = create_engine('sqlite:///youtube_crawl.db')
 Base = declarative_base()
 
 # Define db table models here (inherits from Base class)
@@ -146,6 +1690,7 @@ class Search(Base):
     id = Column(Integer, primary_key=True)
     search = Column(String(length=128), unique=True)
     num_results = Column(Integer)
+    etag = Column(String(length=64))            # Of the response, so a search done again can tell if its results changed
     # The "crawled" flag is just implicitly there already as we only save the row when
     # all sub-queries complete
 
@@ -161,7 +1706,7 @@ class Channel(Base):
     # Titles are not nec. unique, see Veritasium, but that's kinda an exception.
     title = Column(String(length=128))
     description = Column(String(length=1000))
-    keywords = Column(String(length=512))       # Just a comma-separated string of keywords.  e.g. "appliance warranties,diy,cordless drill,fixing"
+    keywords = Column(String(length=512))       # OLD, no longer written: comma-separated string of keywords.  Converted to ChannelKeyword rows (and then set to NULL) by migrate_channel_keywords()
     thumb_default = Column(String(length=256))  # URL of thumbnail.  88 x 88px
     thumb_med = Column(String(length=256))      # URL of medium thumbnail.  240 x 240px
     thumb_high = Column(String(length=256))     # URL of high-res thumbnail.  800 x 800px
@@ -174,317 +1719,342 @@ class Channel(Base):
     video_count = Column(Integer)
     made_for_kids = Column(Boolean)
     potential_contact_emails = Column(String(length=128))   # Comma-separated list of potential contact emails parsed from description
-   
+    stats_updated_at = Column(String(length=32))    # When view/subscriber/video_count were last read (UTC), see ChannelStatSnapshot
+    subscriber_growth = Column(Float)               # Subscribers/day between the last two readings
+    # The raw values the derived fields (country, potential_contact_emails and the creator's ChannelKeywords) come from,
+    # for re-deriving them with yt_reprocess.py.  NULL for channels saved before these were kept.
+    branding_keywords = Column(String(length=1000)) # The creator's own tags, space separated with "quoted phrases"
+    snippet_country = Column(String(length=16))
+    branding_country = Column(String(length=16))
+    expanded_at = Column(String(length=32))     # When discovery expansion went through its listings (UTC), see expand()
+    etag = Column(String(length=64))            # The API's etag of the last full lookup, which changes when anything about the channel does
+    stats_etag = Column(String(length=64))      # The API's etag of the last stats refresh reading (just the statistics part, so not the same as etag)
+    updated_at = Column(String(length=32))      # When the channel or its keywords last changed (UTC), set by triggers for incremental exports, see yt_export.py
+
+class ChannelStatSnapshot(Base):
+    # Every reading of a channel's statistics, for growth curves.  Channel has the latest.
+    __tablename__ = "ChannelStatSnapshot"
+
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(Integer, ForeignKey("Channel.id"))
+    taken_at = Column(String(length=32))        # UTC, e.g. "2020-07-04T18:30:00Z"
+    subscriber_count = Column(BigInteger)
+    view_count = Column(BigInteger)
+    video_count = Column(Integer)
+
+    __table_args__ = (Index("ix_ChannelStatSnapshot_channel_id", "channel_id", "taken_at"),)
+
+class Keyword(Base):
+    __tablename__ = "Keyword"
+
+    id = Column(Integer, primary_key=True)
+    keyword = Column(String(length=128), unique=True)   # Lowercased.  e.g. "appliance warranties"
+
+class ChannelKeyword(Base):
+    # Which keywords a channel is tagged with, and where each tag came from (KEYWORD_SOURCE_CREATOR for the
+    # channel's own tags, KEYWORD_SOURCE_SEARCH for the keywords of our searches that found it).  The same keyword
+    # can be on a channel from both.
+    __tablename__ = "ChannelKeyword"
+
+    channel_id = Column(Integer, ForeignKey("Channel.id"), primary_key=True)
+    keyword_id = Column(Integer, ForeignKey("Keyword.id"), primary_key=True)
+    source = Column(String(length=16), primary_key=True)
+
+    # The primary key covers looking up a channel's keywords, this covers looking up a keyword's channels
+    __table_args__ = (Index("ix_ChannelKeyword_keyword_id", "keyword_id", "channel_id"),)
 
-# create all tables for those that haven't been created yet (uses engine as connectivity source)
-# this won't lose any existing data
-Base.metadata.create_all(engine)
+class ChannelCandidate(Base):
+    # Channels that channels we have mention (featured channels, channel sections, playlists, comments), waiting to be
+    # looked up by discovery expansion if they score high enough.  See expand().
+    __tablename__ = "ChannelCandidate"
 
-# create session handle 
-from sqlalchemy.orm import sessionmaker
-Session = sessionmaker(bind = engine)
-session = Session()
+    id = Column(Integer, primary_key=True)
+    channel_id = Column(String(length=64), unique=True)
+    score = Column(Float)                   # Sum over its mentions, see EXPAND_SOURCES
+    mentions = Column(Integer)
+    found_via = Column(String(length=16))   # What kind of mention (EXPAND_SOURCES) it was first found through
+    status = Column(String(length=16))      # CANDIDATE_PENDING, CANDIDATE_SAVED or CANDIDATE_REJECTED
+    found_at = Column(String(length=32))
+
+    __table_args__ = (Index("ix_ChannelCandidate_status_score", "status", "score"),)
+
+class QuotaLedger(Base):
+    __tablename__ = "QuotaLedger"
+
+    id = Column(Integer, primary_key=True)
+    quota_day = Column(String(length=16))   # Pacific-time date the API counts the quota against, e.g. "2020-07-04"
+    pool = Column(String(length=32))        # Which share of the quota, QUOTA_POOL_DISCOVERY or QUOTA_POOL_REFRESH
+    credits_used = Column(Integer)
+
+    __table_args__ = (UniqueConstraint("quota_day", "pool"),)
+
+class SearchTask(Base):
+    # The search work queue, one row per page of results of each search.  See lease_next_search() for the order
+    # they get done in.  The first pages come from the keywords file (sync_search_tasks()), and each page that
+    # finds new channels queues up the next one (queue_next_page()).
+    __tablename__ = "SearchTask"
+
+    id = Column(Integer, primary_key=True)
+    query = Column(String(length=128))          # e.g. "best appliance warranties"
+    search_type = Column(String(length=16))     # "video" or "channel"
+    keyword = Column(String(length=128))        # Our keyword, without the modifier.  e.g. "appliance warranties"
+    page = Column(Integer)                      # 1 for the first page of results
+    page_token = Column(String(length=64))      # The previous page's nextPageToken, '' for the first page
+    parent_new_channels = Column(Integer)       # New channels the previous page found
+    status = Column(String(length=16))          # TASK_PENDING, TASK_LEASED or TASK_DONE
+    lease_expires_at = Column(String(length=32))    # UTC, while it's leased
+    leased_by = Column(String(length=64))       # WORKER_ID of the crawl that has it (or did it)
+    # Once done:
+    num_results = Column(Integer)
+    new_channels = Column(Integer)              # How many of the results were channels we didn't have yet
+    completed_at = Column(String(length=32))
 
-# Reopen a previously-saved API response to test with for now
-# with open("response.pck", "rb") as fp:
-#     response = pickle.load(fp)
+    __table_args__ = (UniqueConstraint("query", "search_type", "page_token"), Index("ix_SearchTask_status", "status"),
+                      Index("ix_SearchTask_keyword", "keyword", "page"))
 
-# FIXME / TODO / BUGS:
-#
 
-print("Starting YouTube crawl.")
-start = datetime.now()
-elapsed_seconds = 0
-credits_used = 0
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL so that people reading the DB while the crawl runs don't block it (or get blocked by it), and with WAL
+    # synchronous=NORMAL only fsyncs at checkpoints but still can't corrupt the DB
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
+
+def open_database(db_url):
+    # Connect to the DB, and create the tables (and indexes and triggers) that aren't there yet or bring the ones made
+    # by older versions of this script up to date.  This won't lose any existing data.
+    # engine = create_engine('sqlite:///youtube_crawl.db', echo = True) # prints commands to stdout
+    # Sessions get used from the concurrent crawl's threads too, and with crawl workers (--workers) several processes write
+    # to the DB, so wait a while for the other's write to finish instead of failing on a locked DB
+    engine = create_engine(db_url, connect_args={'check_same_thread': False, 'timeout': 60})
+    event.listen(engine, "connect", set_sqlite_pragmas)
+
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine, Search)
+    add_missing_columns(engine, Channel)
+    add_missing_columns(engine, SearchTask)
+    migrate_quota_ledger(engine)
+
+    # Full-text search index over the channels (see yt_query.py), kept up to date by triggers as we save channels
+    create_search_index(engine)
+
+    # Channel.updated_at triggers for exporting only what changed since the last export (see yt_export.py)
+    create_change_tracking(engine)
+    return engine
+
+
+#####################################
+# Main
+#####################################
+
+# The other tools, which `yt_influencers.py <tool> ...` runs (only importing the one asked for)
+TOOLS = {"query": "yt_query", "export": "yt_export", "reprocess": "yt_reprocess"}
+
+# What a crawl or refresh runs on, set up by setup().  At module level so all the functions above can get at them.
+args = None
+engine = None
+Session = None
+session = None
+http = None
+cache = None
+quota = None
+writer = None
+metrics = CrawlMetrics(None, None)      # Counts but doesn't write anything until setup()
 channels_grabbed = 0
+channels_refreshed = 0
+channels_unchanged = 0  # of channels_refreshed
+our_keywords = set()    # See load_our_keywords()
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"    # Who has a SearchTask leased
 
-# Iterate on this ordered list of prefixes/postfixes first, and on inner loop the keywords.
-# This will give us a breadth-first search instead of depth-first
-for key, value in SEARCH_MODIFIERS.items():
 
-    # Open the keywords to search file, need to re-open this file from the beginning with each new
-    # keyword modifier to get the csv_reader iterator to reset.
-    with open(KEYWORD_CSV_FILE, 'r') as f_keywords_r:
-        csv_reader = csv.reader(f_keywords_r, delimiter=',')
-        next(csv_reader, None)  # Skip headers
+def build_parser():
+    # Options for crawl, refresh and expand
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--key", choices=list(API_KEYS), default=DEFAULT_KEY,
+                        help=f"Which API key (from API_KEYS) to use and spend the quota of (default {DEFAULT_KEY}).")
+    common.add_argument("--refresh-share", type=float, default=REFRESH_SHARE,
+                        help=f"Share of the daily quota for refresh, the crawl gets the rest, plus what refresh leaves unspent near the quota reset (default {REFRESH_SHARE}).")
+    common.add_argument("--db", default=DB_URL, help=f"Database URL (default {DB_URL}).  e.g. replay into a fresh DB to re-derive it.")
+    common.add_argument("--cache-dir", default=CACHE_DIR, help=f"Response cache directory (default {CACHE_DIR}).")
+    common.add_argument("--metrics-file", default=METRICS_FILE,
+                        help=f"Prometheus text file to keep the crawl's metrics in, '' for none (default {METRICS_FILE}, or crawl_metrics.<key>.prom for other keys).")
+    common.add_argument("--events-file", default=EVENTS_FILE,
+                        help=f"JSON lines log of every request, sleep, commit and search, '' for none (default {EVENTS_FILE}, same naming).")
+    common.add_argument("--notifier", choices=list(NOTIFIERS),
+                        help=f"How to send the alert when it aborts (default {NOTIFIER}, or whatever yt_influencers.notifier was set to).")
+    # These are mostly for running against the fake API server, see yt_fake_api.py and yt_bench.py
+    common.add_argument("--api-base-url", default=API_BASE_URL, help=f"API base URL (default {API_BASE_URL}).")
+    common.add_argument("--daily-quota", type=int, default=DAILY_QUOTA, help=f"Daily credit budget (default {DAILY_QUOTA}).")
+    common.add_argument("--min-interval", type=float, default=MIN_REQUEST_INTERVAL, help=f"Minimum seconds between API calls (default {MIN_REQUEST_INTERVAL}).")
+
+    parser = argparse.ArgumentParser(description="Builds a SQL database of YouTube channels from searches on the keywords file.",
+                                     epilog="Also runs the other tools: query, export and reprocess (e.g. yt_influencers.py query --help).")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    crawl = commands.add_parser("crawl", parents=[common], help="Look for new channels with the searches from the keywords file (the default).")
+    mode = crawl.add_mutually_exclusive_group()
+    mode.add_argument("--concurrent", action="store_true",
+                      help="Run searches and channel lookups in parallel worker threads (still held to the quota rate).")
+    mode.add_argument("--replay", action="store_true",
+                      help="Re-run the crawl from the response cache only, without sending any API requests (or spending credits).")
+    crawl.add_argument("--workers", type=int,
+                       help="Run this many crawl worker processes, one per key in API_KEYS, all sharing the same search queue.")
+    crawl.add_argument("--search-workers", type=int, default=SEARCH_WORKERS, help="Search threads for --concurrent.")
+    crawl.add_argument("--channel-workers", type=int, default=CHANNEL_WORKERS, help="Channel lookup threads for --concurrent.")
+    crawl.add_argument("--keywords", default=KEYWORD_CSV_FILE, help=f"Keywords file to build the searches from (default {KEYWORD_CSV_FILE}).")
+
+    refresh = commands.add_parser("refresh", parents=[common],
+                                  help="Instead of looking for new channels, refresh the statistics of the ones we have (most overdue first).")
+    refresh.add_argument("--min-age", type=float, default=REFRESH_MIN_AGE.total_seconds() / 3600,
+                         help=f"Only refresh channels last read more than this many hours ago (default {REFRESH_MIN_AGE.total_seconds() / 3600:g}).")
+    # What setup() reads from the crawl's options
+    refresh.set_defaults(replay=False, workers=None, search_workers=1, channel_workers=0, keywords=KEYWORD_CSV_FILE)
+
+    expand = commands.add_parser("expand", parents=[common],
+                                 help="Look for new channels through the ones we have (featured channels, channel sections, playlists and comments), 1 credit a call.")
+    expand.add_argument("--max-credits", type=int, help="Stop after spending this many credits (default: until there's nothing left worth looking up).")
+    expand.set_defaults(replay=False, workers=None, search_workers=1, channel_workers=0, keywords=KEYWORD_CSV_FILE)
+    return parser
+
+
+def setup(run_args):
+    # Open everything a crawl or refresh with these arguments (see build_parser()) runs on: the DB, HTTP session,
+    # response cache, metrics, quota scheduler and DB writer
+    global args, KEYWORD_CSV_FILE, API_BASE_URL, API_KEY, notifier, engine, Session, session, http, cache, metrics, quota, writer
+    args = run_args
+    KEYWORD_CSV_FILE = args.keywords
+    API_BASE_URL = args.api_base_url
+    API_KEY = API_KEYS[args.key]
+    if args.notifier is not None:
+        notifier = NOTIFIERS[args.notifier]     # Otherwise leave it be, it may have been set from Python
+
+    engine = open_database(args.db)
+    Session = sessionmaker(bind = engine)
+    session = Session()
+
+    # FIXME / TODO / BUGS:
+    #
+
+    http = open_http_session(args.search_workers + args.channel_workers)
+
+    # API responses get cached on disk, which is also what --replay runs from
+    cache = ResponseCache(args.cache_dir)
+
+    # Where the time and credits go (see yt_metrics.py), written out as we go and once more on the way out.  With
+    # --workers each worker process keeps its own files, this one has nothing to count.
+    if not args.workers:
+        metrics = CrawlMetrics(per_key_path(args.metrics_file, args.key, DEFAULT_KEY), per_key_path(args.events_file, args.key, DEFAULT_KEY),
+                               const_labels={'key': args.key})
+
+    # Paces all API calls against this mode's share of the daily quota, picking up from what was already spent today
+    # (each key has its own daily quota)
+    if args.command == "refresh":
+        quota = QuotaScheduler(daily_budget=int(args.daily_quota * args.refresh_share), pool=quota_pool(QUOTA_POOL_REFRESH, args.key), min_interval=args.min_interval)
+    else:
+        # Discovery can also have whatever the refresh leaves unspent at the end of the day
+        lender = QuotaScheduler(daily_budget=int(args.daily_quota * args.refresh_share), pool=quota_pool(QUOTA_POOL_REFRESH, args.key), min_interval=args.min_interval)
+        quota = QuotaScheduler(daily_budget=int(args.daily_quota * (1 - args.refresh_share)), pool=quota_pool(QUOTA_POOL_DISCOVERY, args.key), min_interval=args.min_interval,
+                               lender=lender)
+    print(f"Spent {quota.spent} of {quota.daily_budget} {quota.pool} credits so far on quota day {quota.quota_day.isoformat()}.")
+
+    # Convert the keywords of channels saved by older versions of this script
+    migrate_channel_keywords()
+
+    # All the DB writes go through here
+    writer = DbWriter()
+
+
+def run_refresh():
+    print("Starting channel statistics refresh.")
+    refresh_stats(timedelta(hours=args.min_age))
+    print(f"Statistics refresh complete!  Refreshed {channels_refreshed} channels in this run ({channels_unchanged} unchanged).")
+    print_time_spent()
+
+
+def run_expand():
+    global known_channels, our_keywords
+    print("Starting discovery expansion.")
+    known_channels, searched_terms = load_known()
+    our_keywords = load_our_keywords()
+    print(f"Already have {len(known_channels)} channels, scoring candidates on {len(our_keywords)} keyword words.")
+
+    expand(args.max_credits)
+    credits = metrics.total("credits_spent_total")
+    print(f"Discovery expansion complete!  Grabbed {channels_grabbed} channels for {credits} credits "
+          f"({credits / max(channels_grabbed, 1):.2f} credits per channel).  Response cache: {cache.hits} hits, {cache.misses} misses.")
+    print_time_spent()
+
+
+def run_crawl():
+    global known_channels, skipped_tasks, pending_channels, in_flight_channels, pending_searches, our_keywords
+    print("Starting YouTube crawl." + ("  (replaying from the response cache)" if args.replay else ""))
+
+    # What's already in the DB
+    known_channels, searched_terms = load_known()
+    print(f"Already have {len(known_channels)} channels and {len(searched_terms)} searches.")
+
+    # Queue up any searches from the keywords file that aren't in the queue yet
+    sync_search_tasks(searched_terms)
+    our_keywords = load_our_keywords()     # For scoring the featured channels of the ones we save, see add_candidates()
+    skipped_tasks = set()   # ids of the tasks this run couldn't do (not in the cache when replaying), so they don't get picked again
+
+    # Channel lookups are batched up across searches, see next_channel_batch()
+    pending_channels = {}   # channel_id -> set of our search keywords that found it, waiting to be looked up (insertion ordered)
+    in_flight_channels = {} # same, but for the batches that are being looked up right now
+    pending_searches = []   # (Search row, its SearchTask update, set of channel_ids it's still waiting on), saved in order once they're all looked up
+
+    # Keep the leases on our search tasks from running out while we work on them
+    stop_keeping_leases = threading.Event()
+    threading.Thread(target=keep_leases, args=(stop_keeping_leases,), daemon=True).start()
+    try:
+        if args.concurrent:
+            crawl_concurrent(args.search_workers, args.channel_workers)
+        else:
+            crawl()
+    finally:
+        stop_keeping_leases.set()
+        release_leases()
+
+    print(f"YouTube crawl complete!  Grabbed {channels_grabbed} channels in this run.  Response cache: {cache.hits} hits, {cache.misses} misses.")
+    print_time_spent()
+
+
+def main(argv=None):
+    # e.g. main(["crawl", "--concurrent"]).  Returns the exit code.
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv and argv[0] in TOOLS:
+        return importlib.import_module(TOOLS[argv[0]]).main(argv[1:])
+
+    # Older command lines had no subcommand (and --refresh instead of refresh)
+    if not argv or argv[0] not in ("crawl", "refresh", "expand", "-h", "--help"):
+        argv = ["refresh"] + [ arg for arg in argv if arg != "--refresh" ] if "--refresh" in argv else ["crawl"] + argv
+
+    parser = build_parser()
+    run_args = parser.parse_args(argv)
+    if run_args.workers and run_args.replay:
+        parser.error("--workers only runs the crawl, not --replay")
+
+    try:
+        setup(run_args)
+        if run_args.command == "refresh":
+            run_refresh()
+        elif run_args.command == "expand":
+            run_expand()
+        elif run_args.workers:
+            print(f"Starting YouTube crawl with {run_args.workers} workers.")
+            run_workers(run_args.workers, argv[1:])
+            print("YouTube crawl complete!")
+        else:
+            run_crawl()
+    except CrawlAborted as e:
+        print(f"Aborted: {e}")
+        return 1
+    finally:
+        metrics.close()
+    return 0
 
-        # Go through the keywords file
-        for row in csv_reader:
-            # If this modifier (key) is true for this row, apply the search term
-            # e.g. if key="best" then looks for a TRUE in the "best" column of the keywords file.
-            if row[ value['col'] ] == "TRUE":
-                # Determine if prefix or postfix to search query
-                if value['pre_or_post'] == "pre":
-                    # We url encode the search term, but not the actual q= or ? terms later, we don't want those escaped!
-                    search_term = "q=" + urlquote(key + row[KEYWORD_COL].lower().strip())    # e.g. "q=best%20appliance%20warranties"
-                elif value['pre_or_post'] == "post":
-                    search_term = "q=" + urlquote(row[KEYWORD_COL].lower().strip() + key)    # e.g. "q=appliances%20reviews"
-                else:
-                    # Should not get here!
-                    print("Error in pre/post logic!")
-                    print(f"key: {key} value['col']: {value['col']} value['pre_or_post']: {value['pre_or_post']}")
-                    print(f"row: {row}")
-                    print("Aborting script.")
-                    text_me_then_quit()
-
-                # Modify search term to include the search type, "channels" or "videos"
-                if row[TYPE_COL] == "videos":
-                    search_term += "&type=video"                   # e.g. "q=best%20appliance%20warranties&type=videos"
-                elif row[TYPE_COL] == "channels":
-                    search_term += "&type=channel"                 # e.g. "q=appliances%20reviews&type=channels"
-                else:
-                    # Should not get here!
-                    print("Error in video/channel type!")
-                    print(f"keyword: {row[KEYWORD_COL].lower().strip()}")
-                    print(f"row[TYPE_COL]: {row[TYPE_COL]}")
-                    print("Aborting script.")
-                    text_me_then_quit()
-                
-                # Check that we didn't already search this term
-                already_searched = session.query(Search).filter(Search.search == search_term).first()     # Returns first result or None
-                if already_searched:
-                    # If we already searched this term, move on to the next keyword permutation
-                    print(f"Already searched on search term: {search_term}")
-                    continue
-                
-                # Otherwise, didn't search this term already... go on with this same row of keywords file...
-
-                # Build rest of URL for the "search" command
-                url = f'{API_BASE_URL}search?part=snippet&maxResults=50&{search_term}&key={API_KEY}'
-
-                print(f"Searching on search term: {search_term}")
-
-                # Send request and wait for response, up to 3 times
-                for times in range(0, 3):
-                    try:
-                        response = requests.get(
-                            url=url,
-                            headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'}
-                        )
-                    except requests.exceptions.ConnectionError as e:
-                        print(f"Connection error: {e}")
-                        print("Can't connect, are you online?")
-                        if times >= 2:
-                            print("Fatal Error, too many retries.")
-                            text_me_then_quit()
-                        else:
-                            sleep(10**(times+1))    # Sleeps 10 seconds, then 100 seconds (on last failure just aborts)
-                            continue
-
-                    json_response = response.json()
-
-                    # Sanity check everything
-                    if response.status_code == 200:
-                        sleep(SEARCH_SLEEP)     # Got good results, delay here to not get rate limited by API server
-                        credits_used += 100     # Searches cost 100 credits towards quota
-                        break
-                    else:
-                        # If HTTP doesn't return 200, try again after waiting
-                        print(f"Error, invalid status code.  Should be 200, got {response.status_code}")
-                        if times >= 2:
-                            print("Fatal Error, too many retries.")
-                            text_me_then_quit()
-                        else:
-                            sleep(10**(times+1))    # Sleeps 10 seconds, then 100 seconds (on last failure just aborts)
-
-                if json_response['kind'] != "youtube#searchListResponse":
-                    print(f"Fatal Error, should be kind=youtube#searchListResponse, but got kind={json_response['kind']}")
-                    text_me_then_quit()
-
-                # Number of results to further search on
-                num_results = len(json_response['items'])
-                print(f"Got {num_results} results")
-                
-                for item in json_response['items']:
-                    if item['kind'] != "youtube#searchResult":
-                        print(f"Fatal Error, each item should be kind=youtube#searchResult, but got kind={item['kind']}")
-                        text_me_then_quit()
-                    
-                    channel_id = item['snippet']['channelId']       # Get the channel.  Even if the search result was a video, it's the channel for that video.
-                    
-                    # Check if we've already searched for this channel_id before, if it's in the Channel table.
-                    channel = session.query(Channel).filter(Channel.channel_id == channel_id).first()   # Returns first result or None
-                    if channel:
-                        # If we've already searched on this channel, we don't want to search again.
-                        # But we do want to add that search term to its list of keywords
-                        # channel.keywords is just a comma-separated string
-                        keyword_list = [ x for x in channel.keywords.split(',') ]   # ['appliance', 'apple', 'bob is cool', 'whoah']
-                        keyword_list.append(row[KEYWORD_COL].lower().strip())       # Don't include url-encoding, nor the search modifier
-                        keyword_set = set(keyword_list)                             # Make sure these are unique
-                        final_keywords = ','.join(keyword_set)                      # Just a comma separated string again, "apple,bob is cool,appliance,new,whoah"
-                        channel.keywords = final_keywords
-                        try:
-                            session.commit()
-                        except Exception as e:
-                            print(f"Exception {e} when trying to update channel keywords.")
-                            print(f"keyword_list: {keyword_list}")
-                            print(f"final_keywords: {final_keywords}")
-                            session.rollback()
-                            text_me_then_quit()
-                        finally:
-                            print(f"  ..Added keywords for previously-saved channel {channel.title}") # Here using data from database record
-                            session.close()     # Need to get channel.title before closing the session!  :-)
-
-                    else:
-                        # In this case, we haven't searched on this channel before.  Grab all data related to it.
-                        url = f'{API_BASE_URL}channels?part=snippet%2CcontentDetails%2Cstatistics%2CbrandingSettings%2Cstatus&id={channel_id}&key={API_KEY}'
-
-                        # Send request and wait for response, up to 3 times
-                        for times in range(0, 3):
-                            try:
-                                response = requests.get(
-                                    url=url,
-                                    headers={'Accept': 'application/json', 'Accept-Encoding': 'gzip, deflate'}
-                                )
-                            except requests.exceptions.ConnectionError as e:
-                                print(f"Connection error: {e}")
-                                print("Can't connect, are you online?")
-                                if times >= 2:
-                                    print("Fatal Error, too many retries.")
-                                    text_me_then_quit()
-                                else:
-                                    sleep(10**(times+1))    # Sleeps 10 seconds, then 100 seconds (on last failure just aborts)
-                                    continue
-
-                            json_response = response.json()
-
-                            # Sanity check everything
-                            if response.status_code == 200:
-                                sleep(CHANNEL_SLEEP)    # Got good results, delay here to not get rate limited by API server
-                                credits_used += 1       # Channel listings typically cost 1 credits towards quota
-                                break
-                            else:
-                                # If HTTP doesn't return 200, try again after waiting
-                                print(f"Error, invalid status code.  Should be 200, got {response.status_code}")
-                                if times >= 2:
-                                    print("Fatal Error, too many retries.")
-                                    text_me_then_quit()
-                                else:
-                                    sleep(10**(times+1))    # Sleeps 10 seconds, then 100 seconds (on last failure just aborts)
-
-                        if json_response['kind'] != "youtube#channelListResponse":
-                            print(f"Fatal Error, should be kind=youtube#channelListResponse, but got kind={json_response['kind']}")
-                            text_me_then_quit()
-
-                        results_per_page = json_response['pageInfo']['resultsPerPage']
-                        if results_per_page != 1:
-                            print("")
-                            print(f"Error, should only return 1 channel result for id, but returned {results_per_page} resultsPerPage.")
-                            print(f"API url call was: {url}")
-                            print("Continuing crawl.")
-                            print("")
-                            # Don't make this a fatal error, just move along to next channel
-                            continue
-
-                        # If we get to here, was a good #channel response, grab the data
-                        # Already checked that there is only one list item.
-                        snippet = json_response['items'][0]['snippet']
-                        content_details = json_response['items'][0]['contentDetails']
-                        statistics = json_response['items'][0]['statistics']
-                        branding_settings = json_response['items'][0]['brandingSettings']
-                        status = json_response['items'][0]['status']
-
-                        # Set default values on certain keys in case they aren't populated, 
-                        # otherwise will return a KeyError
-                        # If these keys exist, won't overwrite them
-                        snippet.setdefault('customUrl', '')
-                        snippet.setdefault('defaultLanguage', '')
-                        branding_settings['channel'].setdefault('keywords', '')
-                        status.setdefault('madeForKids', False)
-
-                        # Handle channel country, which could be in two different places (snippet, and possibly in brandSettings)
-                        snippet.setdefault('country', '')
-                        branding_settings['channel'].setdefault('country', '')
-                        country = snippet['country'] or branding_settings['channel']['country']     # The OR will take if only one set, prioritize snippet if both set
-                        
-                        # Build keywords to tag this channel
-                        creator_tagged_keywords = branding_settings['channel']['keywords']          # Space separated string on YouTube.  e.g. '"Jamie obrien" surfing "who is job" "weird waves" "river surfing" surf "the wedge" "jamie o\'brien" "how to surf" pipeline hawaii'
-                        final_keywords = parse_keywords(creator_tagged_keywords, row[KEYWORD_COL].lower().strip())  # Parse the creator-tagged keywords, plus add our own search term
-                        
-                        # Extract potential contact emails from the channel description (no way to get through API)
-                        email_at_char = re.findall(r'[\w\._%+-]+@[\w\.-]+', snippet['description'])             # bob@yahoo.com
-                        email_at_spelled_out = re.findall(r'[\w\._%+-]+\sAT\s[\w\.-]+', snippet['description']) # bob AT yahoo.com
-                        email_list = email_at_char + email_at_spelled_out                                       # combine both lists
-                        email_list = [ x.lower() for x in email_list ]      # lowercase all
-                        email_list = list(set(email_list))                  # uniquify duplicates
-                        potential_contact_emails = ','.join(email_list)     # Make a comma-separated string
-
-                        # Create a new channel for DB
-                        new_channel = Channel(
-                            channel_id=channel_id,
-                            title=snippet['title'],
-                            description=snippet['description'],
-                            keywords=final_keywords,
-                            thumb_default=snippet['thumbnails']['default']['url'],
-                            thumb_med=snippet['thumbnails']['medium']['url'],
-                            thumb_high=snippet['thumbnails']['high']['url'],
-                            published_at=snippet['publishedAt'],
-                            custom_url=snippet['customUrl'],
-                            default_language=snippet['defaultLanguage'],
-                            country=country,
-                            view_count=int(statistics['viewCount']),     # YT API returns as string
-                            subscriber_count=int(statistics['subscriberCount']),
-                            video_count=int(statistics['videoCount']),
-                            made_for_kids=status['madeForKids'],
-                            potential_contact_emails=potential_contact_emails
-                        )
-
-                        # Add the channel to the DB
-                        session.add(new_channel)
-                        try:
-                            session.commit()
-                        except Exception as e:
-                            print(f"Exception {e} when trying to add channel.")
-                            session.rollback()
-                            text_me_then_quit()
-                        finally:
-                            session.close()
-                            channels_grabbed += 1
-                            print(f"  Saved results for channel {snippet['title']}")
-
-                # If we get here, we've completed the (50 max) searches on each channel
-                # for that particular modified keyword search.  Save progress to Search table.
-                completed_search = Search(
-                    search=search_term,
-                    num_results=num_results
-                )
-                
-                # Add to Search progress table
-                session.add(completed_search)
-                try:
-                    session.commit()
-                except Exception as e:
-                    print(f"Exception {e} when trying to add completed search for: {search_term}")
-                    session.rollback()
-                    text_me_then_quit()
-                finally:
-                    session.close()
-                    print(f"Saved results for search term: {search_term}\n")
-
-                # Sleep here so that we get down to the average crawl rate
-                while True:
-                    now = datetime.now()
-
-                    # After 24 hours, (86,400 seconds), the datetime delta object rolls over
-                    # Need to handle that case
-                    if (now - start).seconds < elapsed_seconds:
-                        # If the new value of the time delta gets smaller than the last iteration,
-                        # that shouldn't happen, and we've rolled over.  Need to reset the deltas.
-                        start = datetime.now()
-                        credits_used = 0        # restart credit count too
-                        sleep(1)                # don't divide by 0
-                        now = datetime.now()
-    
-                    elapsed_seconds = (now - start).seconds     # int
-                    cur_rate = credits_used / elapsed_seconds
-
-                    if cur_rate > TARGET_RATE:
-                        # Going too fast, need to delay
-                        # Print rate at fixed width of 5 digits with 3 decimal places, and credits used as fixed width of 7 digits
-                        print("... sleep 1m, rate={0:5.3f} (target={1:.3f}).  elapsed_seconds={2:7d}.  credits_used(24 hrs)={3:7d}.  channels_grabbed(this run)={4:7d} ...".format(cur_rate, TARGET_RATE, elapsed_seconds, credits_used, channels_grabbed))
-                        sleep(60)
-                    else:
-                        # Can go again
-                        break
 
-print(f"YouTube crawl complete!  Grabbed {channels_grabbed} channels in this run.")
\ No newline at end of file
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+# Metrics for the crawl (yt_influencers.py): where the wall-clock time and the credits go.
+#
+# Two outputs, both optional:
+#   - a Prometheus text file (e.g. for node_exporter's textfile collector), rewritten every METRICS_WRITE_SECONDS and
+#     at the end, with counters and histograms over the whole run:
+#         yt_api_request_seconds{endpoint="search"}       histogram of API call latency
+#         yt_api_responses_total{endpoint,status}         status codes ("error" for connection errors, 304 for not modified)
+#         yt_api_retries_total{endpoint}
+#         yt_credits_spent_total{pool}  and  yt_quota_spent_today / yt_quota_daily_budget{pool}
+#         yt_credits_borrowed_total{pool,lender}          credits discovery spent from the refresh's leftovers
+#         yt_sleep_seconds_total{reason}                  time spent waiting (on quota, rate limit, retry backoff)
+#         yt_run_seconds                                  wall-clock time since the run started
+#         yt_db_commit_seconds                            histogram of write batch commit latency
+#         yt_search_results_total{search_type,outcome}    search results that were new channels vs already known (and
+#                                                         queued by an earlier search, or a duplicate within the search)
+#         yt_expand_candidates_total{found_via}           channels discovery expansion turned up, see expand_channel()
+#   - a JSON lines event log, one line per API request, sleep, commit, search and expanded channel, e.g.
+#         {"ts": 1719950000.12, "event": "search", "term": "q=best+cooktops", "results": 50, "new": 31, "known": 19}
+#
+# Every metric also gets the labels passed in as const_labels (the API key the crawl runs on), so the files of
+# several crawl workers can be scraped side by side.
+
+import json
+import os
+import threading
+import time
+
+from urllib.parse import urlsplit
+
+#####################################
+# CONSTANTS
+#####################################
+METRICS_FILE = "crawl_metrics.prom"
+EVENTS_FILE = "crawl_events.jsonl"
+METRICS_WRITE_SECONDS = 15
+PREFIX = "yt_"
+
+# Histogram buckets, in seconds
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+COMMIT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+HELP = {
+    "api_request_seconds": ("histogram", "API call latency, by endpoint"),
+    "api_responses_total": ("counter", "API responses, by endpoint and HTTP status (error = no response)"),
+    "api_retries_total": ("counter", "API calls retried after an error"),
+    "credits_spent_total": ("counter", "Quota credits spent this run"),
+    "credits_borrowed_total": ("counter", "Quota credits spent from another pool's leftovers at the end of the quota day"),
+    "quota_spent_today": ("gauge", "Credits spent so far on the current quota day"),
+    "quota_daily_budget": ("gauge", "Daily credit budget"),
+    "sleep_seconds_total": ("counter", "Time spent waiting instead of working, by reason"),
+    "run_seconds": ("gauge", "Wall-clock time since the run started"),
+    "db_commit_seconds": ("histogram", "Write batch commit latency"),
+    "db_rows_committed_total": ("counter", "Rows committed, by kind"),
+    "search_results_total": ("counter", "Search results, by whether they were new channels, already known, queued by an earlier search or repeats within the search"),
+    "searches_total": ("counter", "Searches done"),
+    "channels_saved_total": ("counter", "New channels saved"),
+    "channels_refreshed_total": ("counter", "Channels whose statistics got re-read, by whether they changed (by etag)"),
+    "expand_candidates_total": ("counter", "New channels discovery expansion turned up as candidates, by what mentioned them"),
+    "candidates_looked_up_total": ("counter", "Expansion candidates looked up, by whether they got saved or rejected"),
+    "cache_hits_total": ("gauge", "Response cache hits this run"),
+    "cache_misses_total": ("gauge", "Response cache misses this run"),
+}
+
+#####################################
+# Metrics
+#####################################
+
+def endpoint_name(url):
+    # e.g. "https://www.googleapis.com/youtube/v3/search?part=snippet&..." -> "search"
+    return urlsplit(url).path.rstrip('/').rsplit('/', 1)[-1]
+
+
+def per_key_path(path, key_name, default_key):
+    # Each crawl worker (see --workers) writes its own files: crawl_metrics.prom -> crawl_metrics.key2.prom
+    if not path or key_name == default_key:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{key_name}{ext}"
+
+
+class CrawlMetrics:
+    # Counters, gauges and histograms keyed by (name, sorted label items), plus the event log.  The concurrent
+    # crawl's threads all record into the same one, so everything goes under a lock.
+    # With metrics_file and events_file both None it keeps count but doesn't write anything.
+
+    def __init__(self, metrics_file=METRICS_FILE, events_file=EVENTS_FILE, const_labels=None):
+        self.metrics_file = metrics_file
+        self.const_labels = const_labels or {}
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.last_write = self.started
+        self.values = {}            # counters and gauges: (name, labels) -> value
+        self.histograms = {}        # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self.buckets = {}           # histogram name -> its buckets
+        self.events = open(events_file, 'a', buffering=1, encoding='utf-8') if events_file else None  # line buffered, for tail -f
+
+    def key(self, name, labels):
+        return name, tuple(sorted({**self.const_labels, **labels}.items()))
+
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            key = self.key(name, labels)
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[self.key(name, labels)] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        with self.lock:
+            self.buckets[name] = buckets
+            counts = self.histograms.setdefault(self.key(name, labels), [0] * (len(buckets) + 1) + [0.0])
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[len(buckets)] += 1
+            counts[-1] += value
+
+    def event(self, event, **fields):
+        if self.events is None:
+            return
+        line = json.dumps({'ts': round(time.time(), 3), 'event': event, **self.const_labels, **fields}, separators=(', ', ': '))
+        with self.lock:
+            self.events.write(line + "\n")
+
+    def maybe_write(self):
+        # Cheap enough to call after every request
+        if time.monotonic() - self.last_write >= METRICS_WRITE_SECONDS:
+            self.write()
+
+    def render(self):
+        # The Prometheus text exposition format
+        def label_text(labels):
+            return "{" + ",".join(f'{k}="{str(v)}"' for (k, v) in labels) + "}" if labels else ""
+
+        lines = []
+        described = set()
+        def describe(name):
+            if name not in described:
+                type, help = HELP.get(name, ("untyped", name))
+                lines.append(f"# HELP {PREFIX}{name} {help}")
+                lines.append(f"# TYPE {PREFIX}{name} {type}")
+                described.add(name)
+
+        with self.lock:
+            self.values[self.key("run_seconds", {})] = time.monotonic() - self.started
+            for (name, labels), value in sorted(self.values.items()):
+                describe(name)
+                lines.append(f"{PREFIX}{name}{label_text(labels)} {value}")
+            for (name, labels), counts in sorted(self.histograms.items()):
+                describe(name)
+                for bound, count in zip(self.buckets[name], counts):
+                    lines.append(f"{PREFIX}{name}_bucket{label_text(labels + (('le', str(bound)),))} {count}")
+                lines.append(f"{PREFIX}{name}_bucket{label_text(labels + (('le', '+Inf'),))} {counts[-2]}")
+                lines.append(f"{PREFIX}{name}_sum{label_text(labels)} {counts[-1]}")
+                lines.append(f"{PREFIX}{name}_count{label_text(labels)} {counts[-2]}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        # Write to a temp file and move it into place, so a scrape never sees a half-written file
+        self.last_write = time.monotonic()
+        if not self.metrics_file:
+            return
+        tmp_path = f"{self.metrics_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp_path, self.metrics_file)
+
+    def total(self, name, **labels):
+        # Sum of a counter (or of a histogram's observations) over all the label values that match labels,
+        # e.g. total("sleep_seconds_total") or total("api_request_seconds", endpoint="search")
+        with self.lock:
+            values = list(self.values.items()) + [ (key, counts[-1]) for (key, counts) in self.histograms.items() ]
+            return sum(value for ((n, key_labels), value) in values
+                       if n == name and all((k, v) in key_labels for (k, v) in labels.items()))
+
+    def close(self):
+        self.write()
+        if self.events is not None:
+            self.events.close()
+            self.events = None
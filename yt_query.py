@@ -0,0 +1,197 @@
+# Ranked full-text search over the channels in the crawl database.
+# Uses a SQLite FTS5 index over channel titles, descriptions and keywords, kept up to date by triggers as the
+# crawler (yt_influencers.py) inserts and updates channels, so it never has to be rebuilt.
+#
+# e.g.  python yt_query.py "how-to surf" --country US --min-subs 10000 --max-subs 1000000 --no-kids --has-email
+#       python yt_query.py --fts "surf OR surfing"
+#
+# The query matches channels with all of its words (punctuation like o'brien, how-to or c++ is fine).  With --fts it's
+# an FTS5 query instead, which takes OR, AND, NOT, "quoted phrases", prefix* etc.
+
+import argparse
+import json
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+
+#####################################
+# CONSTANTS
+#####################################
+DB_URL = "sqlite:///youtube_crawl.db"
+
+# bm25() weights for the indexed columns: a match in the title or keywords counts for more than the description
+TITLE_WEIGHT = 5.0
+DESCRIPTION_WEIGHT = 1.0
+KEYWORDS_WEIGHT = 3.0
+
+DEFAULT_LIMIT = 25
+
+# The FTS table is a plain FTS5 table (keeps its own copy of the text) with the Channel's id as its rowid.
+# Everything after creating it is triggers, so the crawler doesn't have to know it's there.
+SEARCH_INDEX_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS ChannelSearch USING fts5(title, description, keywords, tokenize='unicode61 remove_diacritics 2')""",
+
+    # New channels start out with no keywords, those get tagged on right after
+    """CREATE TRIGGER IF NOT EXISTS ChannelSearch_channel_insert AFTER INSERT ON Channel BEGIN
+        INSERT INTO ChannelSearch(rowid, title, description, keywords) VALUES (new.id, new.title, new.description, '');
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS ChannelSearch_channel_update AFTER UPDATE OF title, description ON Channel BEGIN
+        UPDATE ChannelSearch SET title = new.title, description = new.description WHERE rowid = new.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS ChannelSearch_channel_delete AFTER DELETE ON Channel BEGIN
+        DELETE FROM ChannelSearch WHERE rowid = old.id;
+    END""",
+
+    # A keyword can be on a channel from more than one source, only needs indexing the first time
+    # (INSERT OR IGNOREs that don't insert anything don't fire this at all)
+    """CREATE TRIGGER IF NOT EXISTS ChannelSearch_keyword_insert AFTER INSERT ON ChannelKeyword
+    WHEN NOT EXISTS (SELECT 1 FROM ChannelKeyword WHERE channel_id = new.channel_id AND keyword_id = new.keyword_id AND source != new.source)
+    BEGIN
+        UPDATE ChannelSearch SET keywords = (CASE WHEN keywords = '' THEN '' ELSE keywords || ',' END) || (SELECT keyword FROM Keyword WHERE id = new.keyword_id)
+        WHERE rowid = new.channel_id;
+    END""",
+
+    # For the filters
+    """CREATE INDEX IF NOT EXISTS ix_Channel_subscriber_count ON Channel (subscriber_count)""",
+    """CREATE INDEX IF NOT EXISTS ix_Channel_country ON Channel (country)""",
+]
+
+# Filling it in from scratch, only done when it's first created (or with --rebuild)
+SEARCH_INDEX_FILL = """
+    INSERT INTO ChannelSearch(rowid, title, description, keywords)
+    SELECT Channel.id, Channel.title, Channel.description,
+           COALESCE((SELECT group_concat(DISTINCT Keyword.keyword) FROM ChannelKeyword JOIN Keyword ON Keyword.id = ChannelKeyword.keyword_id
+                     WHERE ChannelKeyword.channel_id = Channel.id), '')
+    FROM Channel
+"""
+
+#####################################
+# Helper Functions
+#####################################
+
+def create_search_index(engine, rebuild=False):
+    # Create the FTS index and its triggers if they aren't there yet, and fill it in from the existing channels
+    # the first time.  Safe to call every time the crawler or this script starts.
+    with engine.begin() as conn:
+        exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'ChannelSearch'").first()
+        for statement in SEARCH_INDEX_DDL:
+            conn.exec_driver_sql(statement)
+        if rebuild:
+            conn.exec_driver_sql("DELETE FROM ChannelSearch")
+        if rebuild or not exists:
+            print("Building channel search index...")
+            conn.exec_driver_sql(SEARCH_INDEX_FILL)
+            conn.exec_driver_sql("INSERT INTO ChannelSearch(ChannelSearch) VALUES ('optimize')")
+
+
+def plain_query(query):
+    # An FTS5 query for channels with all of these words, each one quoted so that nothing in it counts as FTS5 syntax,
+    # e.g. 'how-to "surf" c++' -> '"how-to" """surf""" "c++"'
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+def search_channels(engine, query=None, country=None, min_subscribers=None, max_subscribers=None,
+                    made_for_kids=None, has_email=False, sort="relevance", limit=DEFAULT_LIMIT):
+    # Returns a list of dicts, one per matching channel, best match first.
+    # query is an FTS5 query over title/description/keywords (or None to just filter).
+    # sort="relevance" ranks by bm25 and then subscribers, sort="subscribers" by subscribers only.
+    where = []
+    params = {'limit': limit}
+
+    if query:
+        from_clause = "ChannelSearch JOIN Channel ON Channel.id = ChannelSearch.rowid"
+        where.append("ChannelSearch MATCH :query")
+        params['query'] = query
+        rank = f"bm25(ChannelSearch, {TITLE_WEIGHT}, {DESCRIPTION_WEIGHT}, {KEYWORDS_WEIGHT})"
+    else:
+        from_clause = "Channel LEFT JOIN ChannelSearch ON ChannelSearch.rowid = Channel.id"
+        rank = "0"
+        sort = "subscribers"    # nothing to rank on
+
+    if country:
+        where.append("Channel.country = :country")
+        params['country'] = country.upper()
+    if min_subscribers is not None:
+        where.append("Channel.subscriber_count >= :min_subscribers")
+        params['min_subscribers'] = min_subscribers
+    if max_subscribers is not None:
+        where.append("Channel.subscriber_count <= :max_subscribers")
+        params['max_subscribers'] = max_subscribers
+    if made_for_kids is not None:
+        where.append("Channel.made_for_kids = :made_for_kids")
+        params['made_for_kids'] = made_for_kids
+    if has_email:
+        where.append("Channel.potential_contact_emails != ''")
+
+    if sort == "relevance":
+        order = f"{rank}, Channel.subscriber_count DESC"    # bm25() is more negative for better matches
+    else:
+        order = "Channel.subscriber_count DESC"
+
+    sql = f"""
+        SELECT Channel.channel_id, Channel.title, Channel.custom_url, Channel.country, Channel.subscriber_count,
+               Channel.view_count, Channel.video_count, Channel.made_for_kids, Channel.potential_contact_emails,
+               ChannelSearch.keywords AS keywords, {rank} AS rank
+        FROM {from_clause}
+        {"WHERE " + " AND ".join(where) if where else ""}
+        ORDER BY {order}
+        LIMIT :limit
+    """
+    with engine.connect() as conn:
+        return [ dict(row._mapping) for row in conn.execute(text(sql), params) ]
+
+
+def print_results(results):
+    for r in results:
+        print("{0:>11,}  {1:2}  {2}  https://www.youtube.com/channel/{3}".format(r['subscriber_count'] or 0, r['country'] or '--', r['title'], r['channel_id']))
+        if r['potential_contact_emails']:
+            print(f"             emails: {r['potential_contact_emails']}")
+        if r['keywords']:
+            print(f"             keywords: {r['keywords'][:200]}")
+
+
+#####################################
+# Main
+#####################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search the crawled YouTube channels.")
+    parser.add_argument("query", nargs="?", help='Words to look for in the title, description and keywords, e.g. "how-to surf"')
+    parser.add_argument("--fts", action="store_true", help='The query is an FTS5 query, e.g. "surf OR surfing" or "surf*"')
+    parser.add_argument("--country", help="Two letter country code, e.g. US")
+    parser.add_argument("--min-subs", type=int, help="Minimum subscriber count")
+    parser.add_argument("--max-subs", type=int, help="Maximum subscriber count")
+    parser.add_argument("--no-kids", action="store_true", help="Leave out channels that are made for kids")
+    parser.add_argument("--has-email", action="store_true", help="Only channels with a potential contact email")
+    parser.add_argument("--sort", choices=["relevance", "subscribers"], default="relevance")
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    parser.add_argument("--db", default=DB_URL, help=f"Database URL (default {DB_URL})")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the search index from scratch (shouldn't normally be needed)")
+    args = parser.parse_args(argv)
+
+    engine = create_engine(args.db)
+    create_search_index(engine, rebuild=args.rebuild)
+
+    query = args.query if args.fts or not args.query else plain_query(args.query)
+    start = time.perf_counter()
+    try:
+        results = search_channels(engine, query, country=args.country, min_subscribers=args.min_subs,
+                                  max_subscribers=args.max_subs, made_for_kids=(False if args.no_kids else None),
+                                  has_email=args.has_email, sort=args.sort, limit=args.limit)
+    except OperationalError as e:
+        # FTS5 syntax errors in an --fts query
+        parser.error(f"can't search for {args.query!r}: {e.orig}.  Leave out --fts to search for the words as they are.")
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    if args.json:
+        for r in results:
+            print(json.dumps(r))
+    else:
+        print_results(results)
+        print(f"{len(results)} channels in {elapsed_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# Re-derives the fields the crawler works out from each channel's raw data (potential_contact_emails, country and the
+# creator's own keyword tags, see yt_extract.py) for every channel already in the database, without re-crawling.
+# Run it after improving one of the extractors, e.g. to pick up a new way of spelling out emails.
+#
+# e.g.  python yt_reprocess.py
+#       python yt_reprocess.py --fields emails --processes 8
+#
+# Channels are read in chunks (by id, so it never holds more than a few chunks in memory), derived across a process
+# pool, and only the rows that actually changed get written back, one transaction per chunk.
+# Country and keywords come from the raw values the crawler saves with each channel (Channel.branding_keywords etc),
+# so channels saved before it kept those only get their emails re-derived.
+
+import argparse
+import os
+import time
+
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from sqlalchemy import create_engine, text
+
+from yt_extract import parse_keywords, find_emails, channel_country
+from yt_query import DB_URL
+
+#####################################
+# CONSTANTS
+#####################################
+CHUNK_SIZE = 5000
+FIELDS = ("emails", "country", "keywords")
+
+KEYWORD_SOURCE_CREATOR = "creator"      # Same as in yt_influencers.py, see ChannelKeyword
+
+READ_CHUNK_SQL = """
+    SELECT Channel.id, Channel.description, Channel.potential_contact_emails, Channel.country,
+           Channel.branding_keywords, Channel.snippet_country, Channel.branding_country,
+           (SELECT group_concat(Keyword.keyword) FROM ChannelKeyword JOIN Keyword ON Keyword.id = ChannelKeyword.keyword_id
+            WHERE ChannelKeyword.channel_id = Channel.id AND ChannelKeyword.source = :creator) AS creator_keywords
+    FROM Channel
+    WHERE Channel.id > :after_id
+    ORDER BY Channel.id
+    LIMIT :limit
+"""
+
+# The search index (see yt_query.py) only ever adds keywords as they get tagged, so rebuild the changed channels' lists
+REINDEX_KEYWORDS_SQL = """
+    UPDATE ChannelSearch SET keywords = COALESCE((SELECT group_concat(DISTINCT Keyword.keyword) FROM ChannelKeyword
+                                                  JOIN Keyword ON Keyword.id = ChannelKeyword.keyword_id
+                                                  WHERE ChannelKeyword.channel_id = ?), '')
+    WHERE rowid = ?
+"""
+
+#####################################
+# Helper Functions
+#####################################
+
+def derive_chunk(rows, fields):
+    # Runs in the process pool.  rows are READ_CHUNK_SQL rows as tuples, returns a list of
+    # (id, new potential_contact_emails, new country, new set of creator keywords) for the rows where any of them
+    # changed, with None for the ones that didn't (or aren't being re-derived).
+    changes = []
+    for (id, description, emails, country, branding_keywords, snippet_country, branding_country, creator_keywords) in rows:
+        new_emails = new_country = new_keywords = None
+
+        if "emails" in fields:
+            derived = ','.join(find_emails(description or ''))
+            if set(derived.split(',')) != set((emails or '').split(',')):     # Older rows' emails aren't in any order
+                new_emails = derived
+
+        # The rest need the raw values, which older rows don't have
+        if branding_keywords is not None:
+            if "country" in fields:
+                derived = channel_country(snippet_country, branding_country)
+                if derived != (country or ''):
+                    new_country = derived
+            if "keywords" in fields:
+                derived = { x for x in parse_keywords(branding_keywords).split(',') if x }
+                if derived != { x for x in (creator_keywords or '').split(',') if x }:
+                    new_keywords = derived
+
+        if new_emails is not None or new_country is not None or new_keywords is not None:
+            changes.append((id, new_emails, new_country, new_keywords))
+    return changes
+
+
+def read_chunks(engine, chunk_size):
+    # Yields the channels chunk_size at a time, in id order
+    after_id = 0
+    while True:
+        with engine.connect() as conn:
+            rows = [ tuple(row) for row in conn.execute(text(READ_CHUNK_SQL), {'creator': KEYWORD_SOURCE_CREATOR, 'after_id': after_id, 'limit': chunk_size}) ]
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1][0]
+
+
+def write_changes(engine, changes):
+    # Write back one chunk's changes in one transaction.  Straight through the DB driver's executemany, since with
+    # keywords this can be tens of thousands of rows a chunk.
+    emails = [ (new_emails, id) for (id, new_emails, new_country, new_keywords) in changes if new_emails is not None ]
+    countries = [ (new_country, id) for (id, new_emails, new_country, new_keywords) in changes if new_country is not None ]
+    keywords = [ (id, new_keywords) for (id, new_emails, new_country, new_keywords) in changes if new_keywords is not None ]
+
+    with engine.begin() as conn:
+        if emails:
+            conn.exec_driver_sql("UPDATE Channel SET potential_contact_emails = ? WHERE id = ?", emails)
+        if countries:
+            conn.exec_driver_sql("UPDATE Channel SET country = ? WHERE id = ?", countries)
+        if keywords:
+            # Replace each changed channel's creator tags (our search keyword tags stay as they are)
+            conn.exec_driver_sql("DELETE FROM ChannelKeyword WHERE channel_id = ? AND source = ?",
+                                 [ (id, KEYWORD_SOURCE_CREATOR) for (id, new_keywords) in keywords ])
+            conn.exec_driver_sql("INSERT OR IGNORE INTO Keyword (keyword) VALUES (?)",
+                                 [ (keyword,) for keyword in set().union(*( new_keywords for (id, new_keywords) in keywords )) ])
+            conn.exec_driver_sql("""INSERT OR IGNORE INTO ChannelKeyword (channel_id, keyword_id, source)
+                                    SELECT ?, Keyword.id, ? FROM Keyword WHERE Keyword.keyword = ?""",
+                                 [ (id, KEYWORD_SOURCE_CREATOR, keyword) for (id, new_keywords) in keywords for keyword in new_keywords ])
+            conn.exec_driver_sql(REINDEX_KEYWORDS_SQL, [ (id, id) for (id, new_keywords) in keywords ])
+
+    return len(emails), len(countries), len(keywords)
+
+
+def reprocess(engine, fields=FIELDS, processes=None, chunk_size=CHUNK_SIZE):
+    # Re-derive `fields` for every channel.  Keeps at most 2 chunks per process in flight, so memory stays flat
+    # however big the database is.  Returns the number of (channels, emails, countries, keyword lists) changed.
+    processes = processes or os.cpu_count()
+    totals = [0, 0, 0, 0]
+    started = time.perf_counter()
+    chunks = read_chunks(engine, chunk_size)
+    in_flight = {}  # future -> number of rows in the chunk
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        while True:
+            for rows in chunks:
+                in_flight[pool.submit(derive_chunk, rows, fields)] = len(rows)
+                if len(in_flight) >= 2 * processes:
+                    break
+            if not in_flight:
+                break
+
+            done, pending = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                totals[0] += in_flight.pop(future)
+                changed = write_changes(engine, future.result())
+                for i, count in enumerate(changed):
+                    totals[i + 1] += count
+            print(f"  ..{totals[0]} channels reprocessed, {totals[1]} emails, {totals[2]} countries and {totals[3]} keyword lists changed "
+                  f"({totals[0] / (time.perf_counter() - started):.0f} channels/s)")
+
+    return tuple(totals)
+
+
+#####################################
+# Main
+#####################################
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Re-derive the emails, country and creator keywords of the channels in the database.")
+    parser.add_argument("--fields", nargs="+", choices=FIELDS, default=list(FIELDS), help="Which fields to re-derive (default all)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Process pool size (default one per CPU)")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help=f"Channels per chunk (default {CHUNK_SIZE})")
+    parser.add_argument("--db", default=DB_URL, help=f"Database URL (default {DB_URL})")
+    args = parser.parse_args(argv)
+
+    # The crawler may be writing at the same time, wait for its transactions instead of failing
+    engine = create_engine(args.db, connect_args={'timeout': 60})
+
+    start = time.perf_counter()
+    channels, emails, countries, keywords = reprocess(engine, tuple(args.fields), args.processes, args.chunk_size)
+    print(f"Reprocessed {channels} channels in {time.perf_counter() - start:.1f}s: changed {emails} emails, {countries} countries and {keywords} keyword lists.")
+
+
+if __name__ == "__main__":
+    main()